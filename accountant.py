@@ -1,11 +1,58 @@
-from flask import Flask, jsonify, request
-from flasgger import Swagger
+from flask import Flask, jsonify, request, Response
+from docs import LazySwagger
 from datetime import datetime
-from orders import orders
+from aggregates import GROUP_BY, summarize
+from conditional import versioned_response
+from feed import feed
+from metrics import instrument, timed
+from orders import store
+from storage import join_encoded
+from itertools import islice
 import json
 
 app = Flask(__name__)
-swagger = Swagger(app)
+swagger = LazySwagger(app)
+instrument(app)
+
+# Pick up orders changed by the other services before handling a request
+app.before_request(store.refresh)
+
+# Load the orders in the background, so the service answers requests that don't need them meanwhile
+store.preload()
+
+# Change feed of new and updated orders at /accountant/changes
+app.register_blueprint(feed, url_prefix='/accountant')
+
+# Number of orders sent in one chunk of a streamed response
+STREAM_CHUNK_SIZE = 500
+
+# Function to group orders into lists of STREAM_CHUNK_SIZE
+def chunked(orders):
+    orders = iter(orders)
+    while True:
+        with timed('scan'):
+            chunk = list(islice(orders, STREAM_CHUNK_SIZE))
+        if not chunk:
+            return
+        yield chunk
+
+# Function to stream {"orders": [...]} from orders encoded as JSON, the same bytes as join_encoded gives
+def stream_orders_json(encoded_orders):
+    yield b'{"orders":['
+    separator = b''
+    for chunk in chunked(encoded_orders):
+        with timed('serialize'):
+            text = separator + b','.join(chunk)
+        yield text
+        separator = b','
+    yield b']}\n'
+
+# Function to stream orders encoded as JSON as newline-delimited JSON, one order per line
+def stream_orders_ndjson(encoded_orders):
+    for chunk in chunked(encoded_orders):
+        with timed('serialize'):
+            text = b'\n'.join(chunk) + b'\n'
+        yield text
 
 # Endpoint to show all orders
 @app.route('/accountant/orders', methods=['GET'])
@@ -13,7 +60,28 @@ def get_cashier_orders():
     """
     Get all orders.
 
+    Orders are returned in order of their ids. Without limit the whole history
+    is streamed; with limit one page is returned together with the after_id of
+    the next page.
+
     ---
+    parameters:
+      - name: after_id
+        in: query
+        type: integer
+        required: false
+        description: Return only orders with an ID greater than this one.
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: The maximum number of orders to return.
+      - name: format
+        in: query
+        type: string
+        enum: [json, ndjson]
+        required: false
+        description: ndjson streams one order per line instead of a JSON object.
     responses:
       200:
         description: A list of orders.
@@ -31,10 +99,43 @@ def get_cashier_orders():
                       # name: Name of the buyer
                       # productId: ID of the product being ordered
                       # price: Price of the ordered product
+                      # discount: Discount off the full price of the product
                       # date: Date of the order
                       # status: Status of the order (Accepted, Done, Paid)
+                next_after_id:
+                  type: integer
+                  description: The after_id of the next page, null on the last page (only with limit).
+      304:
+        description: Not modified. No order changed since the ETag given in If-None-Match.
+      400:
+        description: Bad request. Invalid after_id, limit or format.
     """
-    return json.dumps({'orders': orders}, indent=2)
+    # Values that aren't integers come back as None
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', type=int)
+    output_format = request.args.get('format', 'json')
+    if ('after_id' in request.args and after_id is None) or ('limit' in request.args and (limit is None or limit < 1)):
+        return jsonify({'error': 'after_id must be an integer and limit a positive integer.'}), 400
+    if output_format not in ('json', 'ndjson'):
+        return jsonify({'error': 'format must be either json or ndjson.'}), 400
+
+    def build_response():
+        # Orders come encoded as JSON, only those changed since they were last sent are encoded again
+        orders = store.iter_orders_json(after_id or 0, limit)
+
+        if output_format == 'ndjson':
+            return Response(stream_orders_ndjson(orders), mimetype='application/x-ndjson')
+
+        if limit is None:
+            # Stream the whole history instead of building it in memory
+            return Response(stream_orders_json(orders), mimetype='application/json')
+
+        page = list(orders)
+        next_after_id = json.loads(page[-1])['id'] if len(page) == limit else None
+        return Response(join_encoded('orders', page, next_after_id=next_after_id), mimetype='application/json')
+
+    # Answered with 304 without touching the orders if the client's copy is current
+    return versioned_response(store.version(), store.last_modified(), build_response, cursor=store.version())
 
 # Endpoint to get orders within a date range
 @app.route('/accountant/orders_by_date', methods=['GET'])
@@ -71,6 +172,7 @@ def get_orders_by_date():
                   # name: Name of the customer
                   # productId: ID of the ordered product
                   # price: Price of the ordered product
+                  # discount: Discount off the full price of the product
                   # date: Date of the order
                   # status: Status of the order
                 properties:
@@ -86,6 +188,9 @@ def get_orders_by_date():
                   price:
                     type: number
                     description: The order price.
+                  discount:
+                    type: number
+                    description: The discount off the full price of the product.
                   date:
                     type: string
                     format: date
@@ -93,6 +198,8 @@ def get_orders_by_date():
                   status:
                     type: string
                     description: The order status.
+      304:
+        description: Not modified. No order changed since the ETag given in If-None-Match.
       400:
         description: Bad request. Invalid date format or missing parameters.
     """
@@ -104,18 +211,92 @@ def get_orders_by_date():
         start_date = datetime.strptime(start_date_str, '%Y-%m-%d')
         end_date = datetime.strptime(end_date_str, '%Y-%m-%d')
 
-        # Filter orders within the specified date range
-        filtered_orders = [
-            order for order in orders
-            if start_date <= datetime.strptime(order['date'], '%Y-%m-%d') <= end_date
-        ]
-
-        return jsonify({'orders': filtered_orders})
+        # Take the orders within the specified date range from the date index
+        return versioned_response(store.version(), store.last_modified(),
+                                  lambda: Response(join_encoded('orders', store.by_date_json(start_date, end_date)),
+                                                   mimetype='application/json'),
+                                  cursor=store.version())
 
     except ValueError as e:
         return jsonify({'error': 'Invalid date format. Please use YYYY-MM-DD.'}), 400
     except Exception as e:
         return jsonify({'error': 'An error occurred while processing the request.'}), 500
 
+# Endpoint to get the revenue, number of orders and discounts within a date range
+@app.route('/accountant/revenue', methods=['GET'])
+def get_revenue():
+    """
+    Get the number of orders, revenue and discounts within a date range, grouped by day, product or status.
+
+    Revenue is the sum of the order prices, pass status=Paid to count only paid
+    orders. Discount is the sum of what the 20% discount on products added more
+    than a month before the order took off the full price. The report is made
+    from totals kept per day, so it takes the same time however many orders
+    there are.
+
+    ---
+    parameters:
+      - name: start_date
+        in: query
+        type: string
+        format: date
+        required: true
+        description: The start date of the range (YYYY-MM-DD).
+      - name: end_date
+        in: query
+        type: string
+        format: date
+        required: true
+        description: The end date of the range (YYYY-MM-DD).
+      - name: group_by
+        in: query
+        type: string
+        enum: [day, product, status]
+        required: false
+        description: How to group the orders (default day).
+      - name: status
+        in: query
+        type: string
+        required: false
+        description: Only count orders with this status (Accepted, Done, Paid).
+    responses:
+      200:
+        description: The totals of each group and of the whole range.
+        schema:
+          type: object
+          properties:
+            groups:
+              type: array
+              items:
+                type: object
+                  # Structure of an individual group
+                  # date, productId or status: The day, product or status of the group
+                  # orders: Number of orders
+                  # revenue: Sum of the order prices
+                  # discount: Sum of the discounts given
+            total:
+              type: object
+              description: The orders, revenue and discount of all groups together.
+      304:
+        description: Not modified. No order changed since the ETag given in If-None-Match.
+      400:
+        description: Bad request. Invalid date format, missing parameters or invalid group_by.
+    """
+    group_by = request.args.get('group_by', 'day')
+    if group_by not in GROUP_BY:
+        return jsonify({'error': 'group_by must be one of day, product or status.'}), 400
+
+    try:
+        start_date = datetime.strptime(request.args.get('start_date', ''), '%Y-%m-%d')
+        end_date = datetime.strptime(request.args.get('end_date', ''), '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'Invalid date format. Please use YYYY-MM-DD.'}), 400
+
+    def build_response():
+        groups, total = summarize(store.daily_totals(start_date, end_date), group_by, request.args.get('status'))
+        return jsonify({'group_by': group_by, 'groups': groups, 'total': total})
+
+    return versioned_response(store.version(), store.last_modified(), build_response)
+
 if __name__ == '__main__':
     app.run(debug=True, port=5003)
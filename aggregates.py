@@ -0,0 +1,99 @@
+from bisect import bisect_left, bisect_right, insort
+from catalog import catalog
+
+# Ways a revenue report can be grouped, and the key each group is returned under
+GROUP_BY = {'day': 'date', 'product': 'productId', 'status': 'status'}
+
+
+# Function to get the discount an order got, i.e. the full price of its product minus its price
+# Orders keep the discount worked out when they were priced, so later catalog changes don't alter it.
+# Only orders taken before that was kept are worked out from the given version of the catalog, or the latest one
+def discount_of(order, products=None):
+    if 'discount' in order:
+        return order['discount']
+    product_id = order.get('productId')
+    price = order.get('price')
+    if product_id is None or price is None:
+        return 0.0
+
+    # Both prices from the same version of the catalog, even if it is reloaded meanwhile
+    products = products or catalog.current()
+    pricing = products.price(product_id, order['date'])
+    if not pricing or not pricing['discount']:
+        return 0.0
+    return round(products.get(product_id)['price'] - price, 2)
+
+
+class DailyTotals:
+    """
+    Number of orders, revenue and discount per day, product and status.
+
+    The totals are updated as orders are added and change status, and are
+    saved with the snapshot of the journal store, so a report for any date
+    range adds up a handful of buckets per day instead of reading the orders.
+    Rows look like (date, product_id, status, orders, revenue, discount).
+    """
+
+    def __init__(self, rows=()):
+        # Totals of each day, e.g. {'2024-01-31': {(1, 'Paid'): [orders, revenue, discount]}}
+        self._days = {}
+        # Days that have totals, kept sorted for date range queries
+        self._sorted_days = []
+        for day, product_id, status, orders, revenue, discount in rows:
+            self._bucket(day)[(product_id, status)] = [orders, revenue, discount]
+
+    # Function to get the totals of a day, adding the day if it has none yet
+    def _bucket(self, day):
+        bucket = self._days.get(day)
+        if bucket is None:
+            bucket = self._days[day] = {}
+            insort(self._sorted_days, day)
+        return bucket
+
+    # Function to count an order in the totals of its day, or out of them with sign=-1
+    def add(self, order, sign=1):
+        totals = self._bucket(order['date']).setdefault((order.get('productId'), order['status']), [0, 0.0, 0.0])
+        totals[0] += sign
+        totals[1] += sign * (order.get('price') or 0)
+        totals[2] += sign * discount_of(order)
+
+    # Function to move an order from the totals of its status to those of another status
+    def move(self, order, status):
+        self.add(order, -1)
+        self.add({**order, 'status': status})
+
+    # Function to yield the rows of the days between two YYYY-MM-DD dates, both inclusive
+    def rows(self, start_date=None, end_date=None):
+        start = 0 if start_date is None else bisect_left(self._sorted_days, start_date)
+        end = len(self._sorted_days) if end_date is None else bisect_right(self._sorted_days, end_date)
+        for day in self._sorted_days[start:end]:
+            for (product_id, status), (orders, revenue, discount) in self._days[day].items():
+                if orders:
+                    yield day, product_id, status, orders, round(revenue, 2), round(discount, 2)
+
+
+# Function to add up rows of daily totals into groups by day, product or status
+# Returns the groups sorted by their key and the total of all of them
+def summarize(rows, group_by, status=None):
+    key_name = GROUP_BY[group_by]
+    groups = {}
+    total = {'orders': 0, 'revenue': 0.0, 'discount': 0.0}
+    for day, product_id, order_status, orders, revenue, discount in rows:
+        if status is not None and order_status != status:
+            continue
+
+        key = {'day': day, 'product': product_id, 'status': order_status}[group_by]
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {key_name: key, 'orders': 0, 'revenue': 0.0, 'discount': 0.0}
+        for summary in (group, total):
+            summary['orders'] += orders
+            summary['revenue'] += revenue
+            summary['discount'] += discount
+
+    # Orders of unknown products are grouped under null, listed last
+    groups = sorted(groups.values(), key=lambda group: (group[key_name] is None, group[key_name]))
+    for summary in groups + [total]:
+        summary['revenue'] = round(summary['revenue'], 2)
+        summary['discount'] = round(summary['discount'], 2)
+    return groups, total
@@ -0,0 +1,159 @@
+import heapq
+import json
+import os
+import sys
+from cache import LRUCache
+from metrics import timed
+from storage import write_json_atomically
+
+# Directory holding the segments of archived orders and their index
+archive_directory_path = 'archive'
+
+# Age in days after which "Paid" orders are moved to the archive when the store is compacted
+# 0 keeps every order in the store
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ORDERS_ARCHIVE_AFTER_DAYS', '0'))
+
+# Number of segments kept in memory after being read
+CACHED_SEGMENTS = 12
+
+
+# Function to find an order in a list of orders sorted by id, returns None if it isn't there
+def find_order(orders, order_id):
+    low, high = 0, len(orders)
+    while low < high:
+        middle = (low + high) // 2
+        if orders[middle]['id'] < order_id:
+            low = middle + 1
+        else:
+            high = middle
+    if low < len(orders) and orders[low]['id'] == order_id:
+        return orders[low]
+    return None
+
+
+class OrderArchive:
+    """
+    "Paid" orders moved out of the order store into immutable segment files.
+
+    Every archiving run writes one segment per month of the orders it moves,
+    sorted by id, and lists it in index.json together with its id range and
+    date range. A lookup by id or by date opens only the segments whose range
+    covers it. Segments are never changed once written, so every process can
+    cache the ones it has read.
+
+    Segments are listed in the index before the orders are removed from the
+    store. If a process dies in between the orders are in both places, and
+    the copy in the store is the one returned.
+    """
+
+    def __init__(self, directory=archive_directory_path, cached_segments=CACHED_SEGMENTS):
+        self.directory = directory
+        self.index_path = os.path.join(directory, 'index.json')
+        self.segments = []
+        self._cache = LRUCache(max_entries=cached_segments)
+        self.reload()
+
+    # Function to read the list of segments again, e.g. after another process archived orders
+    def reload(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as file:
+                self.segments = json.load(file)['segments']
+        else:
+            self.segments = []
+
+    # Function to get the orders of a segment, sorted by id
+    def _load(self, segment):
+        orders = self._cache.get(segment['file'])
+        if orders is None:
+            with timed('load'), open(os.path.join(self.directory, segment['file']), 'r') as file:
+                orders = json.load(file)['orders']
+            self._cache.put(segment['file'], orders)
+        return orders
+
+    # Function to write orders to new segments, one per month, and list them in the index
+    # name tells apart the segments of different runs, e.g. the journal position of the run
+    def add(self, orders, name):
+        months = {}
+        for order in orders:
+            months.setdefault(order['date'][:7], []).append(order)
+
+        os.makedirs(self.directory, exist_ok=True)
+        segments = list(self.segments)
+        for month, month_orders in sorted(months.items()):
+            month_orders.sort(key=lambda order: order['id'])
+            file_name = f'{month}.{name}.json'
+            write_json_atomically(os.path.join(self.directory, file_name), {'month': month, 'orders': month_orders})
+            dates = [order['date'] for order in month_orders]
+            segments.append({
+                'file': file_name,
+                'month': month,
+                'count': len(month_orders),
+                'first_id': month_orders[0]['id'],
+                'last_id': month_orders[-1]['id'],
+                'first_date': min(dates),
+                'last_date': max(dates),
+            })
+
+        segments.sort(key=lambda segment: (segment['first_id'], segment['file']))
+        write_json_atomically(self.index_path, {'segments': segments}, indent=2)
+        self.segments = segments
+
+    # Function to get an archived order by its id, returns None if it isn't archived
+    def get(self, order_id):
+        for segment in self.segments:
+            if segment['first_id'] <= order_id <= segment['last_id']:
+                order = find_order(self._load(segment), order_id)
+                if order is not None:
+                    return dict(order)
+        return None
+
+    # Function to get the archived orders dated between two YYYY-MM-DD dates, sorted by date and id
+    # segments defaults to the current list, callers may pass one they took earlier
+    def by_date(self, start_date, end_date, segments=None):
+        found = {}
+        for segment in self.segments if segments is None else segments:
+            if segment['first_date'] <= end_date and segment['last_date'] >= start_date:
+                for order in self._load(segment):
+                    if start_date <= order['date'] <= end_date:
+                        found[order['id']] = order
+        return sorted(found.values(), key=lambda order: (order['date'], order['id']))
+
+    # Function to yield the archived orders in order of their ids, starting after the given id
+    def iter_orders(self, after_id=0, segments=None):
+        last_id = after_id
+        for group in self._overlapping_groups(self.segments if segments is None else segments):
+            if max(segment['last_id'] for segment in group) <= last_id:
+                continue
+            # Segments of one month written by different runs share an id range
+            orders = heapq.merge(*(self._load(segment) for segment in group), key=lambda order: order['id'])
+            for order in orders:
+                if order['id'] > last_id:
+                    last_id = order['id']
+                    yield order
+
+    # Function to split the segments into groups whose id ranges don't overlap other groups
+    def _overlapping_groups(self, segments):
+        groups = []
+        group_end = None
+        for segment in segments:
+            if groups and segment['first_id'] <= group_end:
+                groups[-1].append(segment)
+                group_end = max(group_end, segment['last_id'])
+            else:
+                groups.append([segment])
+                group_end = segment['last_id']
+        return groups
+
+
+# Archive "Paid" orders older than the given number of days: python archive.py [days]
+if __name__ == '__main__':
+    from orders import JournalOrderStore, open_store
+    store = open_store()
+    if not isinstance(store, JournalOrderStore):
+        sys.exit('Only the journal store keeps orders in memory, there is nothing to archive.')
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else ARCHIVE_AFTER_DAYS
+    if days <= 0:
+        sys.exit('Usage: python archive.py <days>')
+    print(f'Archived {store.archive(days)} orders')
+    # Leave the archived orders out of the snapshot as well
+    store.compact()
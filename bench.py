@@ -0,0 +1,284 @@
+# Benchmark of the order lifecycle and the read endpoints.
+#
+# For each store size a fresh store of synthetic orders is written to a temporary
+# directory. Each service is first started alone in a new process to measure how
+# long it takes to answer its first request and its first request that needs the
+# orders. Then all services are started in a new process, using the Flask test
+# client, and the benchmark drives the lifecycle of new orders
+# (add_new_order -> update_status -> mark_paid -> generate_bill) and calls each
+# read endpoint a number of times. Throughput and p50/p99 latency of every
+# endpoint are printed and written as JSON, and can be compared with an earlier
+# run to spot regressions.
+#
+# Usage: python bench.py [--sizes 10000 100000 1000000] [--backend journal|sqlite]
+#                        [--orders 500] [--reads 10] [--output bench_results.json]
+#                        [--compare earlier_results.json]
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import date, timedelta
+
+# Statuses of the seeded orders, older orders are more likely to be paid
+STATUS_WEIGHTS = {'Accepted': 1, 'Done': 1, 'Paid': 4}
+# Seeded orders are spread over this many days before today
+HISTORY_DAYS = 730
+CUSTOMERS = 5000
+
+
+# First request needing the orders made to each service when measuring its start-up
+STARTUP_URLS = {
+    'products': '/products',
+    'cashier': '/cashier/changes?wait=0',
+    'consultant': '/consultant/changes?wait=0',
+    'accountant': '/accountant/changes?wait=0',
+}
+
+
+# Function to write a snapshot of size synthetic orders, the same ones on every run
+def seed_store(directory, size):
+    os.chdir(directory)
+    from aggregates import DailyTotals, discount_of
+    from catalog import catalog
+    products = catalog.current().products
+    generator = random.Random(size)
+    first_day = date.today() - timedelta(days=HISTORY_DAYS)
+    statuses = list(STATUS_WEIGHTS)
+    weights = list(STATUS_WEIGHTS.values())
+    orders = []
+    for order_id in range(1, size + 1):
+        # Ids grow with the date, as they do in a real store
+        order_date = (first_day + timedelta(days=order_id * HISTORY_DAYS // size)).isoformat()
+        product_id = generator.choice(products)['id']
+        order = {
+            'id': order_id,
+            'name': f'Customer {generator.randrange(CUSTOMERS)}',
+            'productId': product_id,
+            'price': catalog.price(product_id, order_date)['price'],
+            'date': order_date,
+            'status': generator.choices(statuses, weights)[0],
+        }
+        order['discount'] = discount_of(order)
+        orders.append(order)
+    totals = DailyTotals()
+    for order in orders:
+        totals.add(order)
+    with open('orders.json', 'w') as file:
+        json.dump({'generation': 0, 'next_id': size + 1, 'totals': list(totals.rows()), 'orders': orders}, file)
+
+
+# Function to measure the start-up of one service, run in a new process for each service
+def measure_startup(directory, service):
+    os.chdir(directory)
+    start = time.perf_counter()
+    app = importlib.import_module(service).app
+    imported = time.perf_counter()
+    client = app.test_client()
+    client.get('/metrics').close()
+    first_response = time.perf_counter()
+    timed_call(client, 'get', STARTUP_URLS[service])
+    first_orders = time.perf_counter()
+    docs_seconds, _ = timed_call(client, 'get', '/apispec_1.json')
+    return {
+        'service': service,
+        'import_seconds': round(imported - start, 3),
+        'first_response_seconds': round(first_response - start, 3),
+        'first_orders_seconds': round(first_orders - start, 3),
+        'first_docs_seconds': round(docs_seconds, 3),
+    }
+
+
+# Function to call an endpoint and return the time it took in seconds, including streaming the body
+def timed_call(client, method, url, **kwargs):
+    start = time.perf_counter()
+    response = getattr(client, method)(url, **kwargs)
+    response.get_data()
+    elapsed = time.perf_counter() - start
+    response.close()
+    if response.status_code >= 400:
+        raise RuntimeError(f'{method.upper()} {url} failed with status {response.status_code}')
+    return elapsed, response
+
+
+# Function to benchmark one store size, run in a new process so the services load the new store
+def run_size(directory, size, orders, reads):
+    os.chdir(directory)
+    start = time.perf_counter()
+    import cashier
+    import consultant
+    import accountant
+    import products
+    from orders import store
+    # The store is loaded in the background, wait until it is open
+    store.version()
+    load_time = time.perf_counter() - start
+    paid_ids = [order['id'] for order in store.by_status('Paid')]
+
+    cashier_client = cashier.app.test_client()
+    consultant_client = consultant.app.test_client()
+    accountant_client = accountant.app.test_client()
+    products_client = products.app.test_client()
+    latencies = {}
+
+    def call(name, client, method, url, **kwargs):
+        elapsed, response = timed_call(client, method, url, **kwargs)
+        latencies.setdefault(name, []).append(elapsed)
+        return response
+
+    # Lifecycle of new orders
+    for number in range(orders):
+        response = call('POST /cashier/add_new_order', cashier_client, 'post', '/cashier/add_new_order',
+                        json={'name': f'Customer {number % CUSTOMERS}', 'productId': number % 5 + 1})
+        order_id = response.get_json()['order']['id']
+        call('PUT /consultant/update_status/<id>', consultant_client, 'put', f'/consultant/update_status/{order_id}')
+        call('PUT /cashier/mark_paid/<id>', cashier_client, 'put', f'/cashier/mark_paid/{order_id}')
+        call('GET /cashier/generate_bill/<id>', cashier_client, 'get', f'/cashier/generate_bill/{order_id}')
+
+    # Read endpoints, over the seeded history
+    generator = random.Random(size)
+    first_day = date.today() - timedelta(days=HISTORY_DAYS)
+    for _ in range(reads):
+        week_start = first_day + timedelta(days=generator.randrange(HISTORY_DAYS - 7))
+        week = f'start_date={week_start.isoformat()}&end_date={(week_start + timedelta(days=6)).isoformat()}'
+        year = f'start_date={first_day.isoformat()}&end_date={(first_day + timedelta(days=364)).isoformat()}'
+        call('GET /consultant/accepted_orders', consultant_client, 'get', '/consultant/accepted_orders')
+        call('GET /cashier/done_orders', cashier_client, 'get', '/cashier/done_orders')
+        call('GET /cashier/paid_orders', cashier_client, 'get', '/cashier/paid_orders')
+        call('GET /cashier/generate_bill/<id> (history)', cashier_client, 'get',
+             f'/cashier/generate_bill/{generator.choice(paid_ids)}')
+        customer = f'Customer {generator.randrange(CUSTOMERS)}'
+        call('GET /cashier/orders_by_name', cashier_client, 'get', f'/cashier/orders_by_name?name={customer}')
+        call('GET /cashier/orders_by_name (prefix)', cashier_client, 'get',
+             f'/cashier/orders_by_name?name={customer[:-1]}&match=prefix&status=Done')
+        call('GET /cashier/generate_bills?date', cashier_client, 'get',
+             f'/cashier/generate_bills?date={week_start.isoformat()}')
+        call('GET /accountant/orders?limit=100', accountant_client, 'get',
+             f'/accountant/orders?limit=100&after_id={generator.randrange(size)}')
+        call('GET /accountant/orders', accountant_client, 'get', '/accountant/orders')
+        call('GET /accountant/orders_by_date (week)', accountant_client, 'get', f'/accountant/orders_by_date?{week}')
+        call('GET /accountant/orders_by_date (year)', accountant_client, 'get', f'/accountant/orders_by_date?{year}')
+        call('GET /products', products_client, 'get', '/products')
+        call('GET /products/search', products_client, 'get', '/products/search?q=electric&max_price=10000')
+        call('GET /accountant/revenue (year)', accountant_client, 'get', f'/accountant/revenue?{year}&group_by=product')
+
+    store.close()
+    results = [summarize(name, times) for name, times in latencies.items()]
+    return {'size': size, 'load_seconds': round(load_time, 3), 'endpoints': results}
+
+
+# Function to get the count, throughput and latency percentiles of one endpoint
+def summarize(name, times):
+    times = sorted(times)
+    return {
+        'endpoint': name,
+        'requests': len(times),
+        'requests_per_second': round(len(times) / sum(times), 1),
+        'p50_ms': round(percentile(times, 50) * 1000, 3),
+        'p99_ms': round(percentile(times, 99) * 1000, 3),
+    }
+
+
+# Function to get a percentile of sorted values, by the nearest-rank method
+def percentile(values, percent):
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[int(rank) - 1]
+
+
+# Function to get the commit the benchmark was run on, None outside a git checkout
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Function to print the results of a run, with the change against an earlier run if given
+def print_results(run, earlier=None):
+    earlier_results = {}
+    for size_result in (earlier or {}).get('results', []):
+        for endpoint in size_result['endpoints']:
+            earlier_results[size_result['size'], endpoint['endpoint']] = endpoint
+
+    for size_result in run['results']:
+        print(f'\n{size_result["size"]} orders ({run["backend"]}): seeded in {size_result["seed_seconds"]} s, '
+              f'services loaded in {size_result["load_seconds"]} s')
+        print(f'  {"start-up of":<20} {"import s":>10} {"first response s":>18} {"first orders s":>16} {"first docs s":>14}')
+        for startup in size_result['startup']:
+            print(f'  {startup["service"]:<20} {startup["import_seconds"]:>10} {startup["first_response_seconds"]:>18} '
+                  f'{startup["first_orders_seconds"]:>16} {startup["first_docs_seconds"]:>14}')
+        print(f'  {"endpoint":<45} {"requests":>8} {"req/s":>10} {"p50 ms":>10} {"p99 ms":>10}')
+        for endpoint in size_result['endpoints']:
+            line = (f'  {endpoint["endpoint"]:<45} {endpoint["requests"]:>8} {endpoint["requests_per_second"]:>10} '
+                    f'{endpoint["p50_ms"]:>10} {endpoint["p99_ms"]:>10}')
+            previous = earlier_results.get((size_result['size'], endpoint['endpoint']))
+            if previous:
+                change = (endpoint['p50_ms'] - previous['p50_ms']) / previous['p50_ms'] * 100 if previous['p50_ms'] else 0
+                line += f'   p50 {change:+.1f}%'
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the order lifecycle and the read endpoints.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='numbers of orders to seed the store with')
+    parser.add_argument('--backend', choices=['journal', 'sqlite'], default='journal')
+    parser.add_argument('--orders', type=int, default=500, help='new orders taken through the lifecycle per size')
+    parser.add_argument('--reads', type=int, default=10, help='calls of each read endpoint per size')
+    parser.add_argument('--output', default='bench_results.json', help='file to write the results to')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    # A fresh process for every size, so each one imports the services with its own store
+    os.environ['ORDERS_BACKEND'] = args.backend
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for size in args.sizes:
+        directory = tempfile.mkdtemp(prefix='orders-bench-')
+        try:
+            start = time.perf_counter()
+            with context.Pool(1) as pool:
+                pool.apply(seed_store, (directory, size))
+            seed_time = time.perf_counter() - start
+
+            startup = []
+            for service in STARTUP_URLS:
+                with context.Pool(1) as pool:
+                    startup.append(pool.apply(measure_startup, (directory, service)))
+
+            with context.Pool(1) as pool:
+                result = pool.apply(run_size, (directory, size, args.orders, args.reads))
+            results.append({'size': size, 'seed_seconds': round(seed_time, 3), 'startup': startup, **result})
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    run = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'backend': args.backend,
+        'python': platform.python_version(),
+        'orders': args.orders,
+        'reads': args.reads,
+        'results': results,
+    }
+    earlier = None
+    if args.compare:
+        with open(args.compare) as file:
+            earlier = json.load(file)
+    print_results(run, earlier)
+
+    with open(args.output, 'w') as file:
+        json.dump(run, file, indent=2)
+    print(f'\nResults written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
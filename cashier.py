@@ -1,30 +1,67 @@
 from flask import Flask, json, request, jsonify, Response
-from flasgger import Swagger
+from docs import LazySwagger
 import json
 import os
-from datetime import datetime, timedelta
-from orders import orders
-from products import products
+import textwrap
+from datetime import datetime
+from aggregates import discount_of
+from cache import LRUCache
+from catalog import DISCOUNT_LABEL, catalog
+from conditional import versioned_response
+from feed import feed
+from metrics import instrument, timed
+from orders import store
+from storage import join_encoded
 
 app = Flask(__name__)
-swagger = Swagger(app)
+swagger = LazySwagger(app)
+instrument(app)
 
-# Function to write orders to orders.json
-def write_orders_to_json():
-    with open('orders.json', 'w') as file:
-        json.dump(orders, file, indent=2)
+# Pick up orders changed by the other services before handling a request
+app.before_request(store.refresh)
 
-# Function to get the price and date based on productId
-def get_product_info_by_id(product_id):
-    product = next((p for p in products if p['id'] == product_id), None)
-    return {'price': product['price'], 'date': product['date']} if product else None
+# Load the orders in the background, so the service answers requests that don't need them meanwhile
+store.preload()
 
-# Function to check if the difference between two dates is more than one month
-def is_more_than_one_month(date1, date2):
-    date1 = datetime.strptime(date1, '%Y-%m-%d')
-    date2 = datetime.strptime(date2, '%Y-%m-%d')
-    difference = date1 - date2
-    return difference > timedelta(days=30)
+# Change feed of new and updated orders at /cashier/changes
+app.register_blueprint(feed, url_prefix='/cashier')
+
+# Rendered bills of paid orders, keyed by order ID
+bill_cache = LRUCache(max_entries=10000)
+
+# Function to fill in the date, status and price of a new order from the request body
+# Orders of one request are priced from the same version of the catalog, passed as products
+def prepare_order(new_order, current_date, products):
+    # Set the 'date' field to the current date in the format (year, month, day)
+    new_order['date'] = current_date
+
+    # Set the 'status' field to "Accepted"
+    new_order['status'] = "Accepted"
+
+    # Get the price based on 'productId', discounted if the product was added more than a month ago
+    product_id = new_order.get('productId')
+    if product_id is not None:
+        pricing = products.price(product_id, current_date)
+
+        if pricing:
+            new_order['price'] = pricing['price']
+            # Kept with the order, so revenue reports never depend on later catalog changes
+            new_order['discount'] = discount_of(new_order, products)
+
+    # Explicitly define the order of fields
+    ordered_fields = ['id', 'name', 'productId', 'price', 'discount', 'date', 'status']
+    return {key: new_order[key] for key in ordered_fields if key in new_order}
+
+# Function to check one order of a batch, returns an error message or None if it is valid
+def validate_order(new_order, products):
+    if not isinstance(new_order, dict):
+        return 'Order must be an object'
+    if not isinstance(new_order.get('name'), str) or not new_order['name']:
+        return 'Missing or invalid name'
+    product_id = new_order.get('productId')
+    if not isinstance(product_id, int) or isinstance(product_id, bool) or products.get(product_id) is None:
+        return f'Product with ID {product_id} not found'
+    return None
 
 # Endpoint to add a new order
 @app.route('/cashier/add_new_order', methods=['POST'])
@@ -63,49 +100,99 @@ def add_new_order():
                       # name: Name of the buyer
                       # productId: ID of the product being ordered
                       # price: Price of the ordered product
+                      # discount: Discount off the full price of the product
                       # date: Date of the order
                       # status: Status of the order (Accepted, Done, Paid)
       400:
         description: Bad request. Missing or invalid parameters.
     """
-    new_order = request.get_json()
-
-    # Set the 'date' field to the current date in the format (year, month, day)
     current_date = datetime.now().strftime('%Y-%m-%d')
-    new_order['date'] = current_date
+    new_order = prepare_order(request.get_json(), current_date, catalog.current())
 
-    # Set the 'status' field to "Accepted"
-    new_order['status'] = "Accepted"
+    # Record the new order in the order journal, the store assigns its id
+    new_order = store.add_order(new_order)
 
-    if not orders:
-        new_order['id'] = 1  # If the list is empty, set the id to 1
-    else:
-        # Assuming the new order has a unique 'id'
-        new_order_id = max(order['id'] for order in orders) + 1
-        new_order['id'] = new_order_id
+    return jsonify({'message': 'Order added successfully', 'order': new_order}), 201
 
-    # Get product information based on 'productId'
-    product_id = new_order.get('productId')
-    if product_id is not None:
-        product_info = get_product_info_by_id(product_id)
+# Endpoint to add many orders at once
+@app.route('/cashier/add_new_orders', methods=['POST'])
+def add_new_orders():
+    """
+    Add many orders in one request.
 
-        if product_info:
-            # Check the difference between dates and adjust the price if more than one month
-            if is_more_than_one_month(current_date, product_info['date']):
-                new_order['price'] = round(0.8 * product_info['price'], 2)
-            else:
-                new_order['price'] = round(product_info['price'], 2)
+    Every order is checked and priced the same way as in add_new_order. Valid
+    orders get consecutive IDs and are saved together; invalid ones are
+    reported in the results without affecting the rest of the batch.
 
-    # Explicitly define the order of fields
-    ordered_fields = ['id', 'name', 'productId', 'price', 'date', 'status']
-    new_order = {key: new_order[key] for key in ordered_fields if key in new_order}
+    ---
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            orders:
+              type: array
+              items:
+                type: object
+                properties:
+                  name:
+                    type: string
+                    description: The name of the buyer.
+                  productId:
+                    type: integer
+                    description: The ID of the product being ordered.
+    responses:
+      201:
+        description: At least one order was added.
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                message:
+                  type: string
+                added:
+                  type: integer
+                  description: The number of orders added.
+                results:
+                  type: array
+                  items:
+                    type: object
+                      # One result per order of the request, in the same order
+                      # index: Position of the order in the request
+                      # order: The added order (if it was valid)
+                      # error: Why the order was rejected (if it was invalid)
+      400:
+        description: Bad request. The body has no list of orders or none of them is valid.
+    """
+    body = request.get_json(silent=True)
+    new_orders = body.get('orders') if isinstance(body, dict) else None
+    if not isinstance(new_orders, list) or not new_orders:
+        return jsonify({'error': 'Request body must contain a non-empty list of orders'}), 400
 
-    orders.append(new_order)
+    current_date = datetime.now().strftime('%Y-%m-%d')
+    products = catalog.current()
+    results = []
+    valid_orders = []
+    for index, new_order in enumerate(new_orders):
+        error = validate_order(new_order, products)
+        if error:
+            results.append({'index': index, 'error': error})
+        else:
+            results.append({'index': index})
+            valid_orders.append(prepare_order(new_order, current_date, products))
 
-    # Write the updated orders to orders.json
-    write_orders_to_json()
+    # Record all valid orders in one journal write, the store assigns consecutive ids
+    added_orders = iter(store.add_orders(valid_orders))
+    for result in results:
+        if 'error' not in result:
+            result['order'] = next(added_orders)
 
-    return jsonify({'message': 'Order added successfully', 'order': new_order}), 201
+    status_code = 201 if valid_orders else 400
+    return jsonify({'message': f'{len(valid_orders)} of {len(new_orders)} orders added successfully',
+                    'added': len(valid_orders), 'results': results}), status_code
 
 # Endpoint to show all orders with status "Done"
 @app.route('/cashier/done_orders', methods=['GET'])
@@ -131,11 +218,18 @@ def get_done_items():
                       # name: Name of the buyer
                       # productId: ID of the product being ordered
                       # price: Price of the ordered product
+                      # discount: Discount off the full price of the product
                       # date: Date of the order
                       # status: Status of the order (Done)
+      304:
+        description: Not modified. No item became or stopped being "Done" since the ETag given in If-None-Match.
     """
-    done_items = [item for item in orders if item['status'] == 'Done']
-    return jsonify({'done_items': done_items})
+    # Answered with 304 without touching the orders if the client's copy is current
+    # The ETag is the version of one status and may point into a compacted journal, so the feed cursor is sent apart
+    return versioned_response(store.version('Done'), store.last_modified('Done'),
+                              lambda: Response(join_encoded('done_items', store.by_status_json('Done')),
+                                               mimetype='application/json'),
+                              cursor=store.version())
 
 # Endpoint to change the status of an existing order with status "Done" to "Paid"
 @app.route('/cashier/mark_paid/<int:item_id>', methods=['PUT'])
@@ -167,6 +261,7 @@ def mark_item_paid(item_id):
                       # name: Name of the buyer
                       # productId: ID of the product being ordered
                       # price: Price of the ordered product
+                      # discount: Discount off the full price of the product
                       # date: Date of the order
                       # status: Status of the order (Paid)
       404:
@@ -174,14 +269,84 @@ def mark_item_paid(item_id):
     """
     new_status = "Paid"
     
-    for item in orders:
-        if item['id'] == item_id and item['status'] == 'Done':
-            item['status'] = new_status
-            write_orders_to_json()  # Write the updated orders to orders.json
-            return jsonify({'message': f'Status of item {item_id} updated to {new_status}', 'item': item})
+    # Change the status only if the item is still "Done" and record it in the order journal
+    item = store.set_status(item_id, new_status, expected='Done')
+    if item:
+        render_bill(item_id)  # The bill won't change any more, cache it for printing
+        return jsonify({'message': f'Status of item {item_id} updated to {new_status}', 'item': item})
 
     return jsonify({'error': f'Item with ID {item_id} not found or not in "Done" status'}), 404
 
+# Endpoint to change the status of many orders with status "Done" to "Paid" at once
+@app.route('/cashier/mark_paid', methods=['PUT'])
+def mark_items_paid():
+    """
+    Change the status of many orders with status "Done" to "Paid".
+
+    The orders are chosen either by a list of IDs or by the name of the
+    customer, in which case all of their "Done" orders are updated. Orders
+    that don't exist or aren't in "Done" status are skipped and reported.
+
+    ---
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            ids:
+              type: array
+              items:
+                type: integer
+              description: The IDs of the orders to update.
+            name:
+              type: string
+              description: Update all "Done" orders of the customer with this name, ignoring case and extra spaces.
+    responses:
+      200:
+        description: Statuses updated.
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                message:
+                  type: string
+                items:
+                  type: array
+                  items:
+                    type: object
+                      # The updated items, with status "Paid"
+                skipped:
+                  type: array
+                  items:
+                    type: object
+                      # id: ID of the skipped item
+                      # reason: Why the item was not updated
+      400:
+        description: Bad request. Neither a list of IDs nor a name was given.
+    """
+    new_status = "Paid"
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        body = {}
+
+    if isinstance(body.get('name'), str):
+        # All "Done" orders of the customer
+        order_ids = [order['id'] for order in store.by_name(body['name'], status='Done')]
+    elif isinstance(body.get('ids'), list):
+        order_ids = body['ids']
+    else:
+        return jsonify({'error': 'Request body must contain a list of ids or a name'}), 400
+
+    # Apply every valid change and record them in one journal write
+    updated, skipped = store.set_statuses(order_ids, new_status, expected='Done')
+    for item in updated:
+        render_bill(item['id'])  # The bill won't change any more, cache it for printing
+    return jsonify({'message': f'Status of {len(updated)} items updated to {new_status}',
+                    'items': updated, 'skipped': skipped})
+
 # Endpoint to show all orders with status "Paid"
 @app.route('/cashier/paid_orders', methods=['GET'])
 def get_paid_items():
@@ -206,34 +371,99 @@ def get_paid_items():
                       # name: Name of the buyer
                       # productId: ID of the product being ordered
                       # price: Price of the ordered product
+                      # discount: Discount off the full price of the product
                       # date: Date of the order
                       # status: Status of the order (Paid)
+      304:
+        description: Not modified. No item became or stopped being "Paid" since the ETag given in If-None-Match.
+    """
+    # Answered with 304 without touching the orders if the client's copy is current
+    return versioned_response(store.version('Paid'), store.last_modified('Paid'),
+                              lambda: Response(join_encoded('paid_items', store.by_status_json('Paid')),
+                                               mimetype='application/json'),
+                              cursor=store.version())
+
+# Endpoint to find the orders of a customer by name
+@app.route('/cashier/orders_by_name', methods=['GET'])
+def get_orders_by_name():
     """
-    paid_items = [item for item in orders if item['status'] == 'Paid']
-    return jsonify({'paid_items': paid_items})
+    Get the orders of a customer, found by the full name or by the start of it.
 
-# Function to get product information by ID
-def get_product_info_by_id(product_id):
-    product = next((p for p in products if p['id'] == product_id), None)
-    return product if product else None
+    Case and extra spaces in names are ignored. Archived orders are not included.
+
+    ---
+    parameters:
+      - name: name
+        in: query
+        type: string
+        required: true
+        description: The name of the customer, or the start of it with match=prefix.
+      - name: match
+        in: query
+        type: string
+        enum: [exact, prefix]
+        default: exact
+        required: false
+        description: Whether the name must match in full or only the start of the customer's name.
+      - name: status
+        in: query
+        type: string
+        required: false
+        description: Only return orders with this status (Accepted, Done, Paid).
+    responses:
+      200:
+        description: The orders of the customer, in order of their IDs.
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                orders:
+                  type: array
+                  items:
+                    type: object
+                      # Structure of an individual order
+                      # id: Order ID
+                      # name: Name of the buyer
+                      # productId: ID of the product being ordered
+                      # price: Price of the ordered product
+                      # discount: Discount off the full price of the product
+                      # date: Date of the order
+                      # status: Status of the order
+      304:
+        description: Not modified. No order (of the given status) changed since the ETag given in If-None-Match.
+      400:
+        description: Bad request. The name is missing or match is not exact or prefix.
+    """
+    name = request.args.get('name', '')
+    match = request.args.get('match', 'exact')
+    status = request.args.get('status')
+    if not name.strip():
+        return jsonify({'error': 'Pass the name of the customer.'}), 400
+    if match not in ('exact', 'prefix'):
+        return jsonify({'error': 'match must be exact or prefix.'}), 400
+
+    # Answered with 304 without touching the orders if the client's copy is current
+    return versioned_response(store.version(status), store.last_modified(status),
+                              lambda: jsonify({'orders': store.by_name(name, match == 'prefix', status)}),
+                              cursor=store.version())
 
 # Function to generate a bill based on order ID
 def generate_bill(order_id):
-    order = next((o for o in orders if o['id'] == order_id and o['status'] == 'Paid'), None)
-    if order:
+    order = store.get(order_id)
+    if order and order['status'] == 'Paid':
         current_date = datetime.now().strftime('%Y-%m-%d')
         formatted_date = datetime.now().strftime('%d %B, %Y')  # Format date as day, month in words, year
 
         # Create a separate JSON table with Product name, Price, Discount, and Sum
         json_table = []
         product_id = order.get('productId')
-        product_info = get_product_info_by_id(product_id)
-        if product_id is not None and product_info is not None:
-            # Check if the order price is less than the product price
-            if order['price'] < product_info['price']:
-                discount = '20% off'
-            else:
-                discount = ''
+        product_info = catalog.get(product_id)
+        # Orders taken before their product was added to the catalog have no price and no product line
+        if product_id is not None and product_info is not None and order.get('price') is not None:
+            # Priced as the order was, only the product name is taken from the catalog
+            order_discount = discount_of(order)
+            discount = DISCOUNT_LABEL if order_discount > 0 else ''
 
             # Calculate the sum (order price)
             order_sum = order['price']
@@ -241,7 +471,7 @@ def generate_bill(order_id):
             json_table.append({
                 "№": 1,
                 "Product name": product_info['name'],
-                "Price": product_info['price'],
+                "Price": round(order_sum + order_discount, 2),
                 "Discount": discount,
                 "Sum": order_sum
             })
@@ -256,6 +486,25 @@ def generate_bill(order_id):
     else:
         return None
 
+# Function to get the bill of an order as JSON, formatted to be embedded in a response
+# Bills of paid orders only change with the date they are printed on, so they are cached
+def render_bill(order_id):
+    order = store.get(order_id)
+    if not order or order['status'] != 'Paid':
+        return None
+
+    formatted_date = datetime.now().strftime('%d %B, %Y')
+    cached = bill_cache.get(order_id)
+    if cached and cached[0] == formatted_date:
+        return cached[1]
+
+    bill_info = generate_bill(order_id)
+    # Indented as it appears under the "bill" key of json.dumps(..., indent=2)
+    with timed('serialize'):
+        rendered = textwrap.indent(json.dumps(bill_info, indent=2), '  ').lstrip().encode('utf-8')
+    bill_cache.put(order_id, (bill_info['date'], rendered))
+    return rendered
+
 # Endpoint to generate a bill based on order ID
 @app.route('/cashier/generate_bill/<int:order_id>', methods=['GET'])
 def generate_bill_endpoint(order_id):
@@ -296,12 +545,78 @@ def generate_bill_endpoint(order_id):
     404:
       description: Order with the specified ID not found or not in "Paid" status.
     """
-    bill_info = generate_bill(order_id)
-    if bill_info:
-        json_response = json.dumps({'message': 'Bill generated successfully', 'bill': bill_info}, indent=2, sort_keys=False)
+    bill = render_bill(order_id)
+    if bill:
+        json_response = b'{\n  "message": "Bill generated successfully",\n  "bill": ' + bill + b'\n}'
         return Response(response=json_response, status=200, mimetype='application/json')
     else:
         return jsonify({'error': f'Order with ID {order_id} not found or not in "Paid" status'}), 404
 
+# Endpoint to generate the bills of many orders at once
+@app.route('/cashier/generate_bills', methods=['GET'])
+def generate_bills_endpoint():
+    """
+    Generate the bills of many paid orders in one streamed response.
+
+    ---
+    parameters:
+      - name: ids
+        in: query
+        type: string
+        required: false
+        description: Comma-separated IDs of the orders, e.g. 1,2,3.
+      - name: date
+        in: query
+        type: string
+        format: date
+        required: false
+        description: Generate the bills of all paid orders made on this date (YYYY-MM-DD) instead.
+    responses:
+      200:
+        description: Bills generated successfully.
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                bills:
+                  type: array
+                  items:
+                    type: object
+                      # Structure of each bill is the same as in generate_bill
+                missing:
+                  type: array
+                  items:
+                    type: integer
+                  description: IDs of the orders that were not found or are not in "Paid" status.
+      400:
+        description: Bad request. Neither valid IDs nor a valid date were given.
+    """
+    try:
+        if 'ids' in request.args:
+            order_ids = [int(order_id) for order_id in request.args['ids'].split(',') if order_id.strip()]
+        elif 'date' in request.args:
+            order_date = datetime.strptime(request.args['date'], '%Y-%m-%d')
+            order_ids = [order['id'] for order in store.by_date(order_date, order_date) if order['status'] == 'Paid']
+        else:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'Pass either ids as comma-separated integers or date as YYYY-MM-DD.'}), 400
+
+    def generate():
+        missing = []
+        separator = b''
+        yield b'{"bills": ['
+        for order_id in order_ids:
+            bill = render_bill(order_id)
+            if bill:
+                yield separator + bill
+                separator = b', '
+            else:
+                missing.append(order_id)
+        yield b'], "missing": ' + json.dumps(missing).encode('utf-8') + b'}'
+
+    return Response(generate(), mimetype='application/json')
+
 if __name__ == '__main__':
     app.run(debug=True, port=5001)
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import date, timedelta
+from metrics import timed
+
+# File the products are loaded from, a JSON list of {"id", "name", "price", "date"} objects
+# It ships with the code, so by default it is found next to this file rather than in the working directory
+products_file_path = os.environ.get('PRODUCTS_FILE',
+                                    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'products.json'))
+
+# Seconds between checks whether the products file has changed
+RELOAD_INTERVAL = float(os.environ.get('CATALOG_RELOAD_INTERVAL', '1'))
+
+# Products added more than this many days before the order are sold at a discount
+DISCOUNT_AFTER_DAYS = 30
+DISCOUNT_RATE = 0.2
+DISCOUNT_LABEL = '20% off'
+
+# Fields of a product, in the order they are returned
+PRODUCT_FIELDS = ('id', 'name', 'price', 'date')
+
+catalog_log = logging.getLogger('catalog')
+
+
+# Function to split a product name or a search query into lowercase words
+def tokenize(text):
+    return re.findall(r'\w+', text.casefold())
+
+
+class Catalog:
+    """
+    Products indexed by id, with everything needed for pricing worked out once.
+
+    For each product the last day it is sold at full price is kept as a
+    YYYY-MM-DD string. Order dates use the same format, so deciding whether an
+    order gets the discount is a single string comparison instead of parsing
+    two dates on every order.
+
+    A catalog never changes once built, a changed products file gives a new
+    Catalog with a new version. For search every word of a product name maps
+    to the ids of the products having it, and the products are kept sorted by
+    price and by the date they were added, so a search only looks at the
+    products matching its most selective condition.
+    """
+
+    def __init__(self, products, version='0'):
+        self.version = version
+        self.loaded_at = time.time()
+        self._products_by_id = {}
+        self._prices = {}
+        self._ids_by_token = {}
+        for product in products:
+            product = {key: product[key] for key in PRODUCT_FIELDS}
+            full_price_until = date.fromisoformat(product['date']) + timedelta(days=DISCOUNT_AFTER_DAYS)
+            self._products_by_id[product['id']] = product
+            self._prices[product['id']] = (
+                full_price_until.isoformat(),
+                round(product['price'], 2),
+                round((1 - DISCOUNT_RATE) * product['price'], 2),
+            )
+            for token in set(tokenize(product['name'])):
+                self._ids_by_token.setdefault(token, set()).add(product['id'])
+
+        # All products in order of id, as /products lists them
+        self.products = sorted(self._products_by_id.values(), key=lambda product: product['id'])
+        # Products sorted by price and by date added, with the sort keys alongside for bisect
+        self._by_price = sorted(self.products, key=lambda product: product['price'])
+        self._price_keys = [product['price'] for product in self._by_price]
+        self._by_date = sorted(self.products, key=lambda product: product['date'])
+        self._date_keys = [product['date'] for product in self._by_date]
+
+    # Function to get a product by its id, returns None if there is no such product
+    def get(self, product_id):
+        return self._products_by_id.get(product_id)
+
+    # Function to get the price of a product for an order made on the given day (YYYY-MM-DD)
+    # Returns None if there is no such product
+    def price(self, product_id, order_date):
+        prices = self._prices.get(product_id)
+        if prices is None:
+            return None
+
+        full_price_until, full_price, discount_price = prices
+        if order_date > full_price_until:
+            return {'price': discount_price, 'discount': True, 'label': DISCOUNT_LABEL}
+        return {'price': full_price, 'discount': False, 'label': ''}
+
+    # Function to find the products whose name has every word of the query, priced and added within the
+    # given ranges, all bounds inclusive and all conditions optional. Returns the products in order of id
+    def search(self, query=None, min_price=None, max_price=None, added_from=None, added_to=None):
+        tokens = set(tokenize(query or ''))
+        if tokens:
+            postings = sorted((self._ids_by_token.get(token, set()) for token in tokens), key=len)
+            products = [self._products_by_id[product_id] for product_id in postings[0].intersection(*postings[1:])]
+        elif min_price is not None or max_price is not None:
+            products = self._by_price[self._range(self._price_keys, min_price, max_price)]
+        elif added_from is not None or added_to is not None:
+            products = self._by_date[self._range(self._date_keys, added_from, added_to)]
+        else:
+            products = self.products
+
+        # The products left are checked against the conditions the index lookup didn't cover
+        products = [
+            product for product in products
+            if (min_price is None or product['price'] >= min_price)
+            and (max_price is None or product['price'] <= max_price)
+            and (added_from is None or product['date'] >= added_from)
+            and (added_to is None or product['date'] <= added_to)
+        ]
+        products.sort(key=lambda product: product['id'])
+        return products
+
+    # Function to get the slice of sorted keys between two bounds, both inclusive and optional
+    @staticmethod
+    def _range(keys, low, high):
+        start = 0 if low is None else bisect_left(keys, low)
+        end = len(keys) if high is None else bisect_right(keys, high)
+        return slice(start, end)
+
+
+class CatalogFile:
+    """
+    Catalog of the products file, reloaded when the file changes.
+
+    Whether the file changed is checked at most once every ``reload_interval``
+    seconds, when the catalog is used. A changed file is read and indexed into
+    a new Catalog, which then replaces the old one in a single assignment.
+    Code that needs several answers from the same version of the catalog,
+    e.g. to price a whole batch of orders, takes it once with current(). A
+    file that can't be read or parsed leaves the catalog as it was, so the
+    file should be replaced as a whole (written to a temporary file that is
+    then renamed over it) rather than edited in place.
+
+    The version of a catalog is a hash of the file, so every process serving
+    the same file reports the same version.
+    """
+
+    def __init__(self, path=products_file_path, reload_interval=RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._catalog = None
+        # Modification time and size of the file the catalog was read from
+        self._file_stat = None
+        self._check_at = 0
+        self._lock = threading.Lock()
+        self._reload()
+        if self._catalog is None:
+            raise RuntimeError(f'Products file {path} could not be loaded')
+
+    # Function to get the latest catalog, reloading the file first if it has changed
+    def current(self):
+        if time.monotonic() >= self._check_at:
+            self._reload()
+        return self._catalog
+
+    # Function to read the file again if it changed since it was last read
+    def _reload(self):
+        with self._lock:
+            if time.monotonic() < self._check_at:
+                return
+            self._check_at = time.monotonic() + self.reload_interval
+            try:
+                stat = os.stat(self.path)
+                if (stat.st_mtime_ns, stat.st_size) == self._file_stat:
+                    return
+                # Remembered before parsing, so a broken file is reported once rather than on every check
+                self._file_stat = (stat.st_mtime_ns, stat.st_size)
+                with timed('load'):
+                    with open(self.path, 'rb') as file:
+                        data = file.read()
+                    catalog = Catalog(json.loads(data), hashlib.sha1(data).hexdigest()[:16])
+            except (OSError, ValueError, KeyError, TypeError) as error:
+                catalog_log.warning('Could not load the products from %s, keeping the previous catalog: %s',
+                                    self.path, error)
+                return
+            self._catalog = catalog
+
+    # Function to get a product by its id from the latest catalog, returns None if there is no such product
+    def get(self, product_id):
+        return self.current().get(product_id)
+
+    # Function to get the price of a product from the latest catalog, see Catalog.price
+    def price(self, product_id, order_date):
+        return self.current().price(product_id, order_date)
+
+
+# Catalog of the products sold in the store
+catalog = CatalogFile()
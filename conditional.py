@@ -0,0 +1,20 @@
+from datetime import datetime, timezone
+from flask import request, make_response
+
+
+# Function to answer a GET request only if the client doesn't already have this version
+# build_response is called only when the response actually has to be sent
+# cursor, if given, is sent in the X-Changes-Cursor header for the client to follow the change feed from
+def versioned_response(version, last_modified, build_response, cursor=None):
+    if request.if_none_match.contains(version):
+        response = make_response('', 304)
+    else:
+        response = make_response(build_response())
+        if response.status_code != 200:
+            return response
+
+    response.set_etag(version)
+    if cursor is not None:
+        response.headers['X-Changes-Cursor'] = cursor
+    response.last_modified = datetime.fromtimestamp(last_modified, timezone.utc)
+    return response
@@ -1,15 +1,23 @@
-from flask import Flask, jsonify, request
-from flasgger import Swagger
-from orders import orders
-import json
+from flask import Flask, jsonify, request, Response
+from docs import LazySwagger
+from conditional import versioned_response
+from feed import feed
+from metrics import instrument
+from orders import store
+from storage import join_encoded
 
 app = Flask(__name__)
-swagger = Swagger(app)
+swagger = LazySwagger(app)
+instrument(app)
 
-# Function to write orders to orders.json
-def write_orders_to_json():
-    with open('orders.json', 'w') as file:
-        json.dump(orders, file, indent=2)
+# Pick up orders changed by the other services before handling a request
+app.before_request(store.refresh)
+
+# Load the orders in the background, so the service answers requests that don't need them meanwhile
+store.preload()
+
+# Change feed of new and updated orders at /consultant/changes
+app.register_blueprint(feed, url_prefix='/consultant')
 
 # Endpoint to show all accepted orders
 @app.route('/consultant/accepted_orders', methods=['GET'])
@@ -33,6 +41,7 @@ def get_accepted_orders():
                   # name: Name of the customer
                   # productId: ID of the ordered product
                   # price: Price of the ordered product
+                  # discount: Discount off the full price of the product
                   # date: Date of the order
                   # status: Status of the order (Accepted)
                   # Description of each property added for clarity
@@ -49,6 +58,9 @@ def get_accepted_orders():
                   price:
                     type: number
                     description: The order price.
+                  discount:
+                    type: number
+                    description: The discount off the full price of the product.
                   date:
                     type: string
                     format: date
@@ -56,9 +68,15 @@ def get_accepted_orders():
                   status:
                     type: string
                     description: The order status.
+      304:
+        description: Not modified. No order became or stopped being "Accepted" since the ETag given in If-None-Match.
     """
-    accepted_orders = [order for order in orders if order['status'] == 'Accepted']
-    return jsonify({'accepted_orders': accepted_orders})
+    # Answered with 304 without touching the orders if the client's copy is current
+    # The ETag is the version of one status and may point into a compacted journal, so the feed cursor is sent apart
+    return versioned_response(store.version('Accepted'), store.last_modified('Accepted'),
+                              lambda: Response(join_encoded('accepted_orders', store.by_status_json('Accepted')),
+                                               mimetype='application/json'),
+                              cursor=store.version())
 
 # Endpoint to update the status of an existing order
 @app.route('/consultant/update_status/<int:order_id>', methods=['PUT'])
@@ -95,6 +113,7 @@ def update_order_status(order_id):
                 # name: Name of the customer
                 # productId: ID of the ordered product
                 # price: Price of the ordered product
+                # discount: Discount off the full price of the product
                 # date: Date of the order
                 # status: The new status of the order
               description: The updated order details.
@@ -129,13 +148,79 @@ def update_order_status(order_id):
     """
     new_status = "Done"
     
-    for order in orders:
-        if order['id'] == order_id:
-            order['status'] = new_status
-            write_orders_to_json()  # Write the updated orders to orders.json
-            return jsonify({'message': f'Status of order {order_id} updated to {new_status}', 'order': order})
+    order = store.set_status(order_id, new_status)  # Record the status change in the order journal
+    if order:
+        return jsonify({'message': f'Status of order {order_id} updated to {new_status}', 'order': order})
 
     return jsonify({'error': f'Order with ID {order_id} not found'}), 404
 
+# Endpoint to change the status of many orders with status "Accepted" to "Done" at once
+@app.route('/consultant/update_status', methods=['PUT'])
+def update_orders_status():
+    """
+    Change the status of many orders with status "Accepted" to "Done".
+
+    The orders are chosen either by a list of IDs or by the name of the
+    customer, in which case all of their "Accepted" orders are updated. Orders
+    that don't exist or aren't in "Accepted" status are skipped and reported.
+
+    ---
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            ids:
+              type: array
+              items:
+                type: integer
+              description: The IDs of the orders to update.
+            name:
+              type: string
+              description: Update all "Accepted" orders of the customer with this name, ignoring case and extra spaces.
+    responses:
+      200:
+        description: Statuses updated.
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                message:
+                  type: string
+                orders:
+                  type: array
+                  items:
+                    type: object
+                      # The updated orders, with status "Done"
+                skipped:
+                  type: array
+                  items:
+                    type: object
+                      # id: ID of the skipped order
+                      # reason: Why the order was not updated
+      400:
+        description: Bad request. Neither a list of IDs nor a name was given.
+    """
+    new_status = "Done"
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        body = {}
+
+    if isinstance(body.get('name'), str):
+        # All "Accepted" orders of the customer
+        order_ids = [order['id'] for order in store.by_name(body['name'], status='Accepted')]
+    elif isinstance(body.get('ids'), list):
+        order_ids = body['ids']
+    else:
+        return jsonify({'error': 'Request body must contain a list of ids or a name'}), 400
+
+    # Apply every valid change and record them in one journal write
+    updated, skipped = store.set_statuses(order_ids, new_status, expected='Accepted')
+    return jsonify({'message': f'Status of {len(updated)} orders updated to {new_status}',
+                    'orders': updated, 'skipped': skipped})
+
 if __name__ == '__main__':
     app.run(debug=True, port=5002)
@@ -0,0 +1,44 @@
+import threading
+from flask import Flask
+
+# Paths of the pages Flasgger serves: the UI, its static files and the spec
+DOCS_PATHS = ('/apidocs', '/apispec_1.json', '/flasgger_static/')
+
+
+class LazySwagger:
+    """
+    Swagger documentation of a service, set up the first time it is requested.
+
+    Importing Flasgger (and the validation libraries it pulls in) takes longer
+    than the rest of a service's start-up, yet only people reading the docs
+    need it. Requests for the docs pages are passed to a separate app that is
+    built on the first such request, with the same endpoints as the service
+    so Flasgger finds all their docstrings. Every other request goes straight
+    to the service.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.docs_app = None
+        self._wsgi_app = app.wsgi_app
+        self._building = threading.Lock()
+        app.wsgi_app = self
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO', '').startswith(DOCS_PATHS):
+            return self._get_docs_app()(environ, start_response)
+        return self._wsgi_app(environ, start_response)
+
+    # Function to get the app serving the docs, building it if this is the first request for them
+    def _get_docs_app(self):
+        with self._building:
+            if self.docs_app is None:
+                from flasgger import Swagger
+                docs_app = Flask(self.app.import_name)
+                for rule in self.app.url_map.iter_rules():
+                    if rule.endpoint != 'static':
+                        docs_app.add_url_rule(rule.rule, rule.endpoint, self.app.view_functions[rule.endpoint],
+                                              methods=rule.methods)
+                Swagger(docs_app)
+                self.docs_app = docs_app
+        return self.docs_app
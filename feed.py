@@ -0,0 +1,167 @@
+from flask import Blueprint, jsonify, request, Response
+from orders import store
+import json
+import time
+
+# Blueprint with the change feed, registered by each service under its own prefix
+feed = Blueprint('feed', __name__)
+
+# How often the journal is checked for new changes while waiting, in seconds
+POLL_INTERVAL = 0.2
+# Longest time a long-poll request waits for a change, in seconds
+MAX_WAIT = 60
+# Interval between keep-alive comments on an idle event stream, in seconds
+KEEPALIVE_INTERVAL = 15
+
+
+# Function to parse a cursor like "3.1042", as sent in the X-Changes-Cursor header of the order lists
+def parse_cursor(cursor):
+    generation, offset = cursor.strip().strip('"').split('.')
+    return int(generation), int(offset)
+
+
+# Function to turn a journal record into a change event
+def to_event(cursor, record):
+    if record['op'] == 'create':
+        return {'type': 'created', 'cursor': cursor, 'order': record['order']}
+    return {
+        'type': 'status_changed',
+        'cursor': cursor,
+        'id': record['id'],
+        'status': record['status'],
+        'previous_status': record.get('from'),
+        # Current state of the order, which may already include later changes
+        'order': store.get(record['id']),
+    }
+
+
+# Function to check if an event concerns orders with the given status
+def matches_status(event, status):
+    if event['type'] == 'created':
+        return event['order']['status'] == status
+    # Records written before previous_status was kept may concern any status
+    return status in (event['status'], event['previous_status']) or event['previous_status'] is None
+
+
+# Function to get the events after a cursor, returns None if the cursor has expired
+def read_events(cursor, status=None):
+    result = store.changes(cursor)
+    if result is None:
+        return None
+
+    records, cursor = result
+    # Archiving moves orders without changing them, so it isn't an event
+    events = [to_event(version, record) for version, record in records if record['op'] in ('create', 'status')]
+    if status:
+        events = [event for event in events if matches_status(event, status)]
+    return events, cursor
+
+
+# Endpoint to get the changes made to orders since a cursor
+@feed.route('/changes', methods=['GET'])
+def get_changes():
+    """
+    Get the orders created or changed since a cursor.
+
+    Clients fetch the full list of orders once, then pass the X-Changes-Cursor
+    header of that response as the cursor and keep calling this endpoint with
+    the cursor it returns. The request waits
+    until there is at least one change or the wait time runs out. With
+    stream=sse (or an Accept: text/event-stream header) the changes are sent
+    as Server-Sent Events on a connection that stays open.
+
+    ---
+    parameters:
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: Return changes made after this cursor (e.g. the X-Changes-Cursor header of an order list). Defaults to the current state, i.e. only new changes.
+      - name: status
+        in: query
+        type: string
+        required: false
+        description: Only return changes of orders that get or lose this status (Accepted, Done, Paid).
+      - name: wait
+        in: query
+        type: integer
+        required: false
+        description: How many seconds to wait for a change (default 25, at most 60).
+      - name: stream
+        in: query
+        type: string
+        enum: [sse]
+        required: false
+        description: Send the changes as Server-Sent Events instead of a single response.
+    responses:
+      200:
+        description: The changes made since the cursor.
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                events:
+                  type: array
+                  items:
+                    type: object
+                      # Structure of an individual event
+                      # type: created or status_changed
+                      # cursor: Cursor right after this change
+                      # order: The order (its current state for status_changed)
+                      # id, status, previous_status: Only for status_changed
+                cursor:
+                  type: string
+                  description: Cursor to pass to the next request.
+      400:
+        description: Bad request. Invalid cursor or wait time.
+      410:
+        description: The cursor is too old. Fetch the full list of orders again.
+    """
+    status = request.args.get('status')
+    try:
+        cursor = request.args.get('cursor') or request.headers.get('Last-Event-ID')
+        cursor = parse_cursor(cursor) if cursor else parse_cursor(store.version())
+        wait = min(int(request.args.get('wait', 25)), MAX_WAIT)
+        # Reading the changes once checks that the cursor is one the store handed out
+        store.refresh()
+        result = read_events(cursor, status)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor or wait time.'}), 400
+
+    if request.args.get('stream') == 'sse' or request.accept_mimetypes.best == 'text/event-stream':
+        return Response(stream_events(cursor, status), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+
+    deadline = time.monotonic() + wait
+    while True:
+        if result is None:
+            return jsonify({'error': 'Cursor has expired, fetch the orders again.', 'cursor': store.version()}), 410
+
+        events, cursor = result
+        if events or time.monotonic() >= deadline:
+            return jsonify({'events': events, 'cursor': f'{cursor[0]}.{cursor[1]}'})
+        time.sleep(POLL_INTERVAL)
+        store.refresh()
+        result = read_events(cursor, status)
+
+
+# Function to stream the changes after a cursor as Server-Sent Events
+def stream_events(cursor, status):
+    last_sent = time.monotonic()
+    while True:
+        store.refresh()
+        result = read_events(cursor, status)
+        if result is None:
+            yield f'event: expired\ndata: {json.dumps({"cursor": store.version()})}\n\n'
+            return
+
+        events, cursor = result
+        for event in events:
+            yield f'id: {event["cursor"]}\nevent: {event["type"]}\ndata: {json.dumps(event)}\n\n'
+            last_sent = time.monotonic()
+
+        if time.monotonic() - last_sent >= KEEPALIVE_INTERVAL:
+            yield ': keep-alive\n\n'
+            last_sent = time.monotonic()
+        time.sleep(POLL_INTERVAL)
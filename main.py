@@ -1,4 +1,39 @@
+import importlib
 import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+# Services with the port each one listens on
+SERVICES = {
+    'products': 5000,
+    'cashier': 5001,
+    'consultant': 5002,
+    'accountant': 5003,
+}
+
+# Address the supervised services listen on
+HOST = os.environ.get('HOST', '127.0.0.1')
+
+# Seconds between health checks of each service, and how many may fail in a row before it is restarted
+HEALTH_CHECK_INTERVAL = 5
+HEALTH_CHECK_TIMEOUT = 2
+HEALTH_CHECK_FAILURES = 3
+# Time a new worker has to load the orders before its health counts
+STARTUP_GRACE = 30
+
+# Restart delay after a crash, doubled after each crash up to MAX_BACKOFF seconds
+# A worker that stays up for STABLE_AFTER seconds starts over at the shortest delay
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+STABLE_AFTER = 60
+
+# Seconds workers get to finish their requests and flush their writes when stopping
+SHUTDOWN_TIMEOUT = 15
 
 def run_file(file_name):
     try:
@@ -8,6 +43,172 @@ def run_file(file_name):
         # Handle keyboard interrupt (Ctrl+C) and print a message
         print("\nProcess interrupted. Returning to the main menu.")
 
+# Function to run one worker of a service on a listening socket made by the supervisor
+# Without a socket the worker binds the port of the service itself
+def serve(name, fd=None):
+    from werkzeug.serving import make_server
+    app = importlib.import_module(name).app
+    server = make_server(HOST, SERVICES[name], app, threaded=True, fd=fd)
+    # Request threads are joined on shutdown, so requests in progress are finished
+    server.daemon_threads = False
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it can't run on this thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server.serve_forever()
+    server.server_close()
+
+    # Force the order writes of the finished requests to disk
+    orders = sys.modules.get('orders')
+    if orders is not None:
+        orders.store.close()
+
+class Worker:
+    """One worker process of a supervised service, restarted with a growing delay when it crashes."""
+
+    def __init__(self, service, number):
+        self.service = service
+        self.number = number
+        self.process = None
+        self.started_at = 0
+        self.backoff = MIN_BACKOFF
+        self.restart_at = 0
+
+    def start(self, listener):
+        command = [sys.executable, os.path.abspath(__file__), '--serve', self.service]
+        pass_fds = ()
+        if listener is not None:
+            command += ['--fd', str(listener.fileno())]
+            pass_fds = (listener.fileno(),)
+        self.process = subprocess.Popen(command, pass_fds=pass_fds)
+        self.started_at = time.monotonic()
+        print(f'Started {self.service} worker {self.number} (pid {self.process.pid})', flush=True)
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    # Function to note that the worker exited and work out when to start it again
+    def exited(self):
+        if time.monotonic() - self.started_at >= STABLE_AFTER:
+            self.backoff = MIN_BACKOFF
+        print(f'{self.service} worker {self.number} exited with code {self.process.returncode}, '
+              f'restarting in {self.backoff} s', flush=True)
+        self.restart_at = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+        self.process = None
+
+    def stop(self):
+        if self.running():
+            self.process.terminate()
+
+class Supervisor:
+    """
+    Runs every service as a set of worker processes and keeps them running.
+
+    The supervisor opens the listening socket of each service and passes it to
+    the workers, so all workers of a service accept connections on the same
+    port. Each worker is a threaded non-debug server. Crashed workers are
+    started again after a delay that grows with repeated crashes, and the
+    workers of a service that fails its health check (GET /metrics) several
+    times in a row are restarted. On SIGTERM or Ctrl+C the workers are asked
+    to stop, finish their requests and flush their order writes.
+
+    Windows can't pass sockets to new processes, so there every service runs
+    a single worker that opens the port itself.
+    """
+
+    def __init__(self, workers):
+        self.listeners = {}
+        self.workers = []
+        self.health_failures = {name: 0 for name in workers}
+        self.next_health_check = time.monotonic() + HEALTH_CHECK_INTERVAL
+        self.stopping = threading.Event()
+        for name, count in workers.items():
+            if os.name == 'nt':
+                count = 1
+            else:
+                self.listeners[name] = socket.create_server((HOST, SERVICES[name]), backlog=128)
+                self.listeners[name].set_inheritable(True)
+            self.workers += [Worker(name, number) for number in range(1, count + 1)]
+
+    def run(self):
+        handlers = {number: signal.signal(number, lambda signum, frame: self.stopping.set())
+                    for number in (signal.SIGTERM, signal.SIGINT)}
+        for worker in self.workers:
+            worker.start(self.listeners.get(worker.service))
+
+        while not self.stopping.wait(0.5):
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.process is not None and not worker.running():
+                    worker.exited()
+                elif worker.process is None and now >= worker.restart_at:
+                    worker.start(self.listeners.get(worker.service))
+            if now >= self.next_health_check:
+                self.check_health()
+                self.next_health_check = now + HEALTH_CHECK_INTERVAL
+
+        self.stop()
+        for number, handler in handlers.items():
+            signal.signal(number, handler)
+
+    # Function to check that every service answers, restarting the workers of those that keep failing
+    def check_health(self):
+        for name in self.health_failures:
+            workers = [worker for worker in self.workers if worker.service == name]
+            if any(time.monotonic() - worker.started_at < STARTUP_GRACE for worker in workers):
+                continue
+
+            host = '127.0.0.1' if HOST in ('0.0.0.0', '') else HOST
+            try:
+                with urllib.request.urlopen(f'http://{host}:{SERVICES[name]}/metrics',
+                                            timeout=HEALTH_CHECK_TIMEOUT) as response:
+                    healthy = response.status == 200
+            except OSError:
+                healthy = False
+
+            self.health_failures[name] = 0 if healthy else self.health_failures[name] + 1
+            if self.health_failures[name] >= HEALTH_CHECK_FAILURES:
+                print(f'{name} failed {HEALTH_CHECK_FAILURES} health checks in a row, restarting it', flush=True)
+                self.health_failures[name] = 0
+                for worker in workers:
+                    worker.stop()
+
+    def stop(self):
+        print('Stopping the services', flush=True)
+        for worker in self.workers:
+            worker.stop()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            try:
+                worker.process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                print(f'{worker.service} worker {worker.number} did not stop in time, killing it', flush=True)
+                worker.process.kill()
+        for listener in self.listeners.values():
+            listener.close()
+
+# Function to read worker counts like "cashier=4" from the command line, 1 for services not given
+def parse_workers(args):
+    workers = {name: 1 for name in SERVICES}
+    for arg in args:
+        name, _, count = arg.partition('=')
+        if name not in SERVICES or not count.isdigit() or int(count) < 1:
+            sys.exit(f'Invalid worker count {arg!r}, expected e.g. cashier=4 for one of {", ".join(SERVICES)}')
+        workers[name] = int(count)
+    return workers
+
+def supervise(args=()):
+    workers = parse_workers(args)
+    print('Starting ' + ', '.join(f'{name} on port {SERVICES[name]} ({count} workers)'
+                                  for name, count in workers.items()), flush=True)
+    Supervisor(workers).run()
+
 def main():
     while True:
         print("\nChoose a file to run:")
@@ -15,7 +216,8 @@ def main():
         print("2. Consultant (consultant.py)")
         print("3. Accountant (accountant.py)")
         print("4. Products (products.py)")
-        print("5. Quit")
+        print("5. All services (supervisor)")
+        print("6. Quit")
 
         choice = input("Enter the number of your choice: ")
 
@@ -28,10 +230,18 @@ def main():
         elif choice == '4':
             run_file("products.py")
         elif choice == '5':
+            supervise()
+        elif choice == '6':
             print("Quitting the program. Goodbye!")
             break
         else:
             print("Invalid choice. Please enter a valid number.")
 
 if __name__ == "__main__":
-    main()
+    # python main.py --supervise [cashier=4 ...] runs every service without the menu
+    if sys.argv[1:2] == ['--supervise']:
+        supervise(sys.argv[2:])
+    elif sys.argv[1:2] == ['--serve']:
+        serve(sys.argv[2], int(sys.argv[4]) if sys.argv[3:4] == ['--fd'] else None)
+    else:
+        main()
@@ -0,0 +1,159 @@
+import inspect
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import Response, g, request
+from flask.json.provider import DefaultJSONProvider
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Requests taking at least this many milliseconds are logged with the time of each phase
+# 0 turns the log off
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '0'))
+
+slow_request_log = logging.getLogger('slow_requests')
+
+# Time spent in each phase by the request the current thread is handling
+_local = threading.local()
+
+
+class Histogram:
+    """
+    Prometheus histogram with a series of buckets per combination of label values.
+
+    Observations are counted in the first bucket they fit in, the counts are
+    only added up into Prometheus' cumulative buckets when rendered.
+    """
+
+    def __init__(self, name, description, label_names, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        # Counts of each bucket plus +Inf, then the sum of the observed values
+        self._series = {}
+        self._lock = threading.Lock()
+
+    # Function to record a value for the given label values
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    # Function to get the histogram in the Prometheus text format
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, list(counts)) for labels, counts in self._series.items())
+        for label_values, counts in series:
+            labels = ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(self.label_names, label_values))
+            separator = ',' if labels else ''
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append(f'{self.name}_bucket{{{labels}{separator}le="{bound}"}} {total}')
+            lines.append(f'{self.name}_sum{{{labels}}} {counts[-1]}')
+            lines.append(f'{self.name}_count{{{labels}}} {total}')
+        return '\n'.join(lines) + '\n'
+
+
+# Function to escape a label value for the Prometheus text format
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Time taken to handle a request.',
+                             ('endpoint', 'method', 'status'))
+PHASE_DURATION = Histogram('storage_phase_duration_seconds',
+                           'Time spent loading, scanning, persisting and serializing orders.', ('phase',))
+
+
+# Time a phase of the work: load, scan, persist or serialize
+# A phase started again inside itself, e.g. a reload while catching up, is counted once
+@contextmanager
+def timed(phase):
+    active = getattr(_local, 'active', None)
+    if active is None:
+        active = _local.active = set()
+    if phase in active:
+        yield
+        return
+
+    active.add(phase)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        active.discard(phase)
+        PHASE_DURATION.observe(elapsed, phase)
+        phases = getattr(_local, 'phases', None)
+        if phases is not None:
+            phases[phase] = phases.get(phase, 0) + elapsed
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """JSON provider of the services that counts the time spent in jsonify as serialization."""
+
+    def dumps(self, obj, **kwargs):
+        with timed('serialize'):
+            return super().dumps(obj, **kwargs)
+
+
+# Endpoint to show the metrics of this process
+def get_metrics():
+    """
+    Get the request and storage timings of this process in the Prometheus text format.
+
+    ---
+    responses:
+      200:
+        description: The metrics in the Prometheus text format.
+    """
+    return Response(REQUEST_DURATION.render() + PHASE_DURATION.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+# Function to time every request of an app and serve the timings at /metrics
+# Must be called before other before_request functions are added, so they are timed too
+def instrument(app):
+    app.json = TimedJSONProvider(app)
+    app.add_url_rule('/metrics', 'metrics', get_metrics, methods=['GET'])
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        _local.phases = {}
+
+    @app.after_request
+    def record_request_time(response):
+        started = g.get('request_started', time.perf_counter())
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        method = request.method
+        request_path = request.full_path.rstrip('?')
+        phases = getattr(_local, 'phases', None)
+        if phases is None:
+            phases = {}
+
+        # Streamed responses are still being generated here, so stop the timer once they are sent
+        def finish():
+            elapsed = time.perf_counter() - started
+            _local.phases = None
+            REQUEST_DURATION.observe(elapsed, endpoint, method, response.status_code)
+            if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+                breakdown = ', '.join(f'{phase} {seconds * 1000:.1f} ms' for phase, seconds in sorted(phases.items()))
+                slow_request_log.warning('%s %s %s took %.1f ms (%s)', method, request_path, response.status_code,
+                                         elapsed * 1000, breakdown or 'no storage phases')
+
+        if inspect.isgenerator(response.response):
+            response.call_on_close(finish)
+        else:
+            finish()
+        return response
@@ -1,15 +1,940 @@
+import atexit
+import gc
+import glob
+import heapq
 import json
 import os
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager
+from datetime import date, timedelta
+from itertools import islice
+from sys import intern
+from aggregates import DailyTotals, discount_of
+from metrics import timed
+from archive import ARCHIVE_AFTER_DAYS, OrderArchive, archive_directory_path
+from storage import OrderStore, check_transitions, encode_order, normalize_name, write_json_atomically
 
-# Check if 'orders.json' file exists, and create it if not
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Storage engine used by the services: 'journal' (JSON snapshot plus journal) or 'sqlite'
+BACKEND = os.environ.get('ORDERS_BACKEND', 'journal')
+
+# Snapshot of all orders and the append-only journals of changes made since that snapshot
 orders_file_path = 'orders.json'
+journal_file_path = 'orders.journal'
+# File locked by whichever process is changing the store
+lock_file_path = 'orders.lock'
+
+# A new snapshot is written in the background once the journal grows to this fraction of the
+# snapshot, so the snapshot is rewritten less often as the store grows and every write pays the same
+# share of it, and once it is at least COMPACT_MIN_BYTES, so small stores aren't rewritten every few writes
+COMPACT_RATIO = 0.5
+COMPACT_MIN_BYTES = 1024 * 1024
+
+# When journal writes are forced to disk:
+#   'fsync' - before every request returns
+#   'group' - by a background thread every COMMIT_INTERVAL_MS, requests wait for it,
+#             so concurrent requests share one fsync
+#   'async' - by a background thread every COMMIT_INTERVAL_MS, requests don't wait
+#             (a crash may lose the last COMMIT_INTERVAL_MS of changes)
+DURABILITY = os.environ.get('ORDERS_DURABILITY', 'async')
+COMMIT_INTERVAL_MS = int(os.environ.get('ORDERS_COMMIT_INTERVAL_MS', '10'))
+DURABILITY_MODES = ('fsync', 'group', 'async')
+
+
+# Function to take an exclusive lock on an open file, shared by every process using the store
+def lock_file(file):
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+    else:
+        file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                # LK_LOCK gives up after ten seconds, keep waiting
+                continue
+
+
+# Function to release a lock taken with lock_file
+def unlock_file(file):
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# Function to check that an offset is the start of a complete record of a journal, or its end
+# Raises ValueError if it isn't
+def check_record_start(path, offset):
+    with open(path, 'rb') as file:
+        size = file.seek(0, os.SEEK_END)
+        if not 0 <= offset <= size:
+            raise ValueError(f'Offset {offset} is outside the journal')
+        if offset > 0:
+            file.seek(offset - 1)
+            if file.read(1) != b'\n':
+                raise ValueError(f'Offset {offset} is not at the start of a journal record')
+
+
+# Function to yield every complete record of a journal after an offset, with the offset after it
+# Blank lines are yielded as None
+def read_records(path, offset):
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        data = file.read()
+
+    # A record without its newline is still being written
+    end = data.rfind(b'\n') + 1
+    for line in data[:end].split(b'\n')[:-1]:
+        offset += len(line) + 1
+        yield offset, json.loads(line) if line.strip() else None
+
+
+# Turn off the cyclic garbage collector for a while, if it is on
+@contextmanager
+def gc_paused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# Marks a field the order doesn't have, e.g. the price of an order of an unknown product
+MISSING = object()
+
+
+class OrderRecord:
+    """
+    Compact in-memory form of an order kept by the journal store.
+
+    A dict per order costs several hundred bytes once its keys and values are
+    counted. A record with __slots__ needs a fraction of that, and the values
+    repeated across orders (status, date, customer name) are interned so all
+    orders share a single copy of each. to_dict() gives back the order as the
+    endpoints return it.
+
+    to_json() encodes the order the first time a list including it is sent and
+    keeps the bytes until the order changes. The bytes are kept with the
+    status they were encoded with, so an encoding raced by a status change is
+    never mistaken for the current one.
+    """
+
+    __slots__ = ('id', 'name', 'product_id', 'price', 'discount', 'date', 'status', 'encoded')
+
+    def __init__(self, order):
+        self.set(order)
+
+    # Function to replace the fields of the record with those of an order dict
+    def set(self, order):
+        name = order.get('name', MISSING)
+        self.id = order['id']
+        self.name = intern(name) if type(name) is str else name
+        self.product_id = order.get('productId', MISSING)
+        self.price = order.get('price', MISSING)
+        self.discount = order.get('discount', MISSING)
+        if self.discount is MISSING and self.price is not MISSING:
+            # Orders priced before the discount was kept get it worked out once, the next snapshot keeps it
+            self.discount = discount_of(order)
+        self.date = intern(order['date'])
+        self.status = intern(order['status'])
+        # (status, JSON bytes) of the order once encoded
+        self.encoded = None
+
+    def to_dict(self):
+        order = {'id': self.id}
+        if self.name is not MISSING:
+            order['name'] = self.name
+        if self.product_id is not MISSING:
+            order['productId'] = self.product_id
+        if self.price is not MISSING:
+            order['price'] = self.price
+        if self.discount is not MISSING:
+            order['discount'] = self.discount
+        order['date'] = self.date
+        order['status'] = self.status
+        return order
+
+    # Function to get the order as JSON bytes, see encode_order
+    def to_json(self):
+        encoded = self.encoded
+        if encoded is not None and encoded[0] is self.status:
+            return encoded[1]
+        order = self.to_dict()
+        encoded = self.encoded = (order['status'], encode_order(order))
+        return encoded[1]
+
+
+# Functions to get an order given as an OrderRecord, or as a dict if it was read from the archive,
+# as a dict, as JSON bytes, and as the keys the store sorts orders by
+def order_dict(order):
+    return order if type(order) is dict else order.to_dict()
+
+
+def order_json(order):
+    return encode_order(order) if type(order) is dict else order.to_json()
+
+
+def order_id(order):
+    return order['id'] if type(order) is dict else order.id
+
+
+def order_date_id(order):
+    return (order['date'], order['id']) if type(order) is dict else (order.date, order.id)
+
+
+class JournalOrderStore(OrderStore):
+    """
+    Orders kept in memory and persisted as a snapshot plus an append-only journal.
+
+    Every mutation appends one small JSON line to the journal instead of rewriting
+    the whole snapshot. The cashier, consultant and accountant processes share the
+    same files: each one remembers how far into the journal it has read and
+    ``refresh`` applies only the records written since then. Writers hold a file
+    lock, catch up, and then append, so no process overwrites another's changes.
+
+    Orders are held as compact OrderRecords, indexed by id, by status, by
+    normalized customer name and by date (as arrays of integers), and every status
+    change moves the order to its new bucket, so neither a lookup, listing the
+    orders of one status or customer nor a date range query walks the whole history. New
+    ids come from a sequence saved in the snapshot, so an id is never handed
+    out twice.
+
+    The position in the journal after the last change serves as the version of
+    the store, and the position of the last change touching each status as the
+    version of that status. Every process reading the same journal arrives at
+    the same versions, so they can be used as ETags.
+
+    Journals are numbered by generation. Once the current journal grows past
+    ``compact_ratio`` times the size of the snapshot (and ``compact_min_bytes``)
+    a new generation is started and a background thread writes a snapshot of
+    everything before it, so replay time stays bounded by the size of the
+    store while the cost of snapshots per write stays the same.
+
+    "Paid" orders older than ``archive_after_days`` are moved to an OrderArchive
+    at each compaction, so neither memory nor the snapshot grows with years of
+    closed orders. get, by_date and iter_orders read the archive segments that
+    overlap the query, the other queries see only the orders still in memory.
+
+    Revenue reports are answered from DailyTotals, which every record applied
+    keeps up to date and which is saved with the snapshot, archived orders
+    included.
+
+    The store is safe to use from many threads and from many worker processes,
+    including workers forked from a parent that already opened it.
+
+    Journal writes always reach the operating system before the lock is
+    released, so other processes see them at once. When they are forced to disk
+    depends on ``durability``, see DURABILITY.
+    """
+
+    def __init__(self, snapshot_path=orders_file_path, journal_path=journal_file_path,
+                 lock_path=lock_file_path, compact_ratio=COMPACT_RATIO, compact_min_bytes=COMPACT_MIN_BYTES,
+                 durability=DURABILITY, commit_interval_ms=COMMIT_INTERVAL_MS,
+                 archive_directory=archive_directory_path, archive_after_days=ARCHIVE_AFTER_DAYS):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f'durability must be one of {", ".join(DURABILITY_MODES)}, not {durability!r}')
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self.archive_after_days = archive_after_days
+        self.archived = OrderArchive(archive_directory)
+        self.orders = []
+        self.generation = 0
+        # Id given to the next new order
+        self.next_id = 1
+        self._orders_by_id = {}
+        # Orders of each status keyed by id, e.g. {'Done': {2: OrderRecord}}
+        self._orders_by_status = {}
+        # Orders of each normalized customer name in order of id, and the names kept sorted for prefix search
+        self._orders_by_name = {}
+        self._names = []
+        # Order dates as day ordinals kept sorted, with the order ids in the same positions
+        self._dates = array('l')
+        self._date_ids = array('q')
+        # Day ordinal of each date string seen, so every date is parsed only once
+        self._ordinals = {}
+        self.totals = DailyTotals()
+        # Journal position of the last change to the orders of each status, and when it was seen
+        self._status_versions = {}
+        self._base_version = (0, 0)
+        self._modified_at = {}
+        self._loaded_at = time.time()
+        # Byte offset of the first record in the current journal not applied yet
+        self._offset = 0
+        # Size of the last snapshot seen, the journal is compacted relative to it
+        self._snapshot_bytes = 0
+        self._journal = None
+        self._compacting = False
+        self.durability = durability
+        self.commit_interval = commit_interval_ms / 1000
+        # Number of journal writes made by this process, and how many of them are on disk
+        self._written = 0
+        self._synced = 0
+        self._synced_changed = threading.Condition()
+        self._closed = False
+        self._committer = None
+        self._lock = threading.RLock()
+        self._lock_path = lock_path
+        self._lock_file = open(lock_path, 'a+')
+        self._lock_depth = 0
+
+        with timed('load'), self._locked():
+            self._reload()
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+        # Pending writes are forced to disk when the process exits cleanly
+        atexit.register(self.close)
+        self._start_committer()
+
+    # Function to start the background thread forcing journal writes to disk
+    def _start_committer(self):
+        if self.durability != 'fsync':
+            self._committer = threading.Thread(target=self._run_committer, daemon=True)
+            self._committer.start()
+
+    def _run_committer(self):
+        while not self._closed:
+            time.sleep(self.commit_interval)
+            self.sync()
+
+    # Function to give a forked worker its own locks
+    # File locks belong to the open file, which a forked child would share with its parent
+    def _after_fork(self):
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_file = open(self._lock_path, 'a+')
+        self._journal = None
+        # Threads of the parent don't exist in the child
+        self._compacting = False
+        self._written = self._synced = 0
+        self._synced_changed = threading.Condition()
+        self._start_committer()
+
+    # Function to get the journal file of a generation
+    def _journal_file(self, generation):
+        return f'{self.journal_path}.{generation}'
+
+    # Lock the store against other threads and other processes
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if self._lock_depth == 0:
+                lock_file(self._lock_file)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    unlock_file(self._lock_file)
+
+    # Function to load the snapshot and replay the journals written after it
+    def _reload(self):
+        # Loading creates millions of objects that can't form reference cycles, which
+        # would otherwise set off the cycle collector over and over for nothing
+        with gc_paused():
+            if not os.path.exists(self.snapshot_path):
+                # If the file doesn't exist, create it and initialize it with no orders
+                write_json_atomically(self.snapshot_path, {'generation': 0, 'orders': []})
+
+            with open(self.snapshot_path, 'r') as file:
+                data = json.load(file)
+
+            # orders.json used to hold a bare list of orders
+            if isinstance(data, list):
+                data = {'generation': 0, 'orders': data}
+
+            self.archived.reload()
+            self.orders = [OrderRecord(order) for order in data.pop('orders')]
+            self._orders_by_id = {order.id: order for order in self.orders}
+            if 'next_id' in data:
+                self.next_id = data['next_id']
+            else:
+                self.next_id = max(self._orders_by_id, default=0) + 1
+            self._orders_by_status = {}
+            for order in self.orders:
+                self._orders_by_status.setdefault(order.status, {})[order.id] = order
+            self._orders_by_name = {}
+            # Names are interned, so each distinct name is normalized only once
+            keys = {}
+            for order in self.orders:
+                if type(order.name) is str:
+                    key = keys.get(order.name)
+                    if key is None:
+                        key = keys[order.name] = normalize_name(order.name)
+                    self._orders_by_name.setdefault(key, []).append(order)
+            self._names = sorted(self._orders_by_name)
+            del keys
+            if 'totals' in data:
+                self.totals = DailyTotals(data.pop('totals'))
+            else:
+                # Snapshots written before the totals were kept, count every order once
+                self.totals = DailyTotals()
+                for order in self.orders:
+                    self.totals.add(order.to_dict())
+                for order in self.archived.iter_orders():
+                    if order['id'] not in self._orders_by_id:
+                        self.totals.add(order)
+            self._ordinals = {}
+            dates = sorted((self._ordinal(order.date), order.id) for order in self.orders)
+            self._dates = array('l', (day for day, _ in dates))
+            self._date_ids = array('q', (order_id for _, order_id in dates))
+            del dates
+            self.generation = data['generation']
+            self._offset = 0
+            self._snapshot_bytes = os.path.getsize(self.snapshot_path)
+            self._close_journal()
+            self._status_versions = {}
+            self._base_version = (self.generation, 0)
+            self._modified_at = {}
+            self._loaded_at = time.time()
+
+            journal = self._journal_file(self.generation)
+            if not os.path.exists(journal):
+                open(journal, 'ab').close()
+            self._catch_up()
+
+            # Drop a torn record left behind by a process that crashed mid-write
+            journal = self._journal_file(self.generation)
+            if os.path.getsize(journal) > self._offset:
+                with open(journal, 'r+b') as file:
+                    file.truncate(self._offset)
+
+    # Function to apply the journal records written since the last read
+    def _catch_up(self):
+        with timed('load'):
+            while True:
+                journal = self._journal_file(self.generation)
+                if not os.path.exists(journal):
+                    # Our journal was removed by a compaction, start over from the snapshot
+                    with self._locked():
+                        self._reload()
+                    return
+
+                # Once the next generation exists nothing more is written to this journal
+                rotated = os.path.exists(self._journal_file(self.generation + 1))
+                if os.path.getsize(journal) > self._offset:
+                    self._read_journal(journal)
+                if not rotated:
+                    return
+
+                self._close_journal()
+                self.generation += 1
+                self._offset = 0
+                # The process that started the generation is writing a new snapshot, the old size is close enough
+                self._snapshot_bytes = os.path.getsize(self.snapshot_path)
+
+    # Function to apply every complete record of a journal after the current offset
+    def _read_journal(self, path):
+        for offset, record in read_records(path, self._offset):
+            self._offset = offset
+            if record is not None:
+                self._apply(record)
+
+    # Function to apply a single journal record to the in-memory orders
+    def _apply(self, record):
+        if record['op'] == 'create':
+            order = record['order']
+            existing = self._orders_by_id.get(order['id'])
+            self.next_id = max(self.next_id, order['id'] + 1)
+            if existing is not None:
+                # Records are idempotent, so replaying a journal twice is harmless
+                self.totals.add(existing.to_dict(), -1)
+                self.totals.add(order)
+                self._move(existing, order['status'])
+                existing.set(order)
+            else:
+                self.totals.add(order)
+                order = OrderRecord(order)
+                self.orders.append(order)
+                self._orders_by_id[order.id] = order
+                self._orders_by_status.setdefault(order.status, {})[order.id] = order
+                if type(order.name) is str:
+                    key = normalize_name(order.name)
+                    if key not in self._orders_by_name:
+                        insort(self._names, key)
+                    # New orders have the highest id, so the list stays in order of id
+                    self._orders_by_name.setdefault(key, []).append(order)
+                self._touch(order.status)
+                # New orders are dated today, so this is almost always an append
+                day = self._ordinal(order.date)
+                position = bisect_right(self._dates, day)
+                self._dates.insert(position, day)
+                self._date_ids.insert(position, order.id)
+        elif record['op'] == 'status':
+            order = self._orders_by_id.get(record['id'])
+            if order is not None:
+                self.totals.move(order.to_dict(), record['status'])
+                self._move(order, record['status'])
+        elif record['op'] == 'archive':
+            # The segments were listed in the archive index before this record was written
+            self.archived.reload()
+            bucket = self._orders_by_status.get(record['status'], {})
+            archived = [order for order in bucket.values() if order.date < record['before']]
+            if archived:
+                self._remove(archived)
+
+    # Function to get the day ordinal of a YYYY-MM-DD date
+    def _ordinal(self, order_date):
+        day = self._ordinals.get(order_date)
+        if day is None:
+            day = self._ordinals[order_date] = date.fromisoformat(order_date).toordinal()
+        return day
+
+    # Function to change the status of an order and move it to the matching status bucket
+    def _move(self, order, status):
+        bucket = self._orders_by_status.get(order.status)
+        if bucket is not None:
+            bucket.pop(order.id, None)
+        self._touch(order.status, status)
+        order.status = intern(status)
+        self._orders_by_status.setdefault(status, {})[order.id] = order
+
+    # Function to drop orders from memory and from every index
+    def _remove(self, orders):
+        removed = {order.id for order in orders}
+        for order in orders:
+            del self._orders_by_id[order.id]
+            del self._orders_by_status[order.status][order.id]
+        # New lists rather than changes in place, so iterations already running aren't disturbed
+        self.orders = [order for order in self.orders if order.id not in removed]
+        for key in {normalize_name(order.name) for order in orders if type(order.name) is str}:
+            kept = [order for order in self._orders_by_name[key] if order.id not in removed]
+            if kept:
+                self._orders_by_name[key] = kept
+            else:
+                del self._orders_by_name[key]
+                self._names.pop(bisect_left(self._names, key))
+        kept = [position for position, order_id in enumerate(self._date_ids) if order_id not in removed]
+        self._dates = array('l', (self._dates[position] for position in kept))
+        self._date_ids = array('q', (self._date_ids[position] for position in kept))
+        self._touch(*{order.status for order in orders})
+
+    # Function to record that the orders of the given statuses changed at the current journal position
+    def _touch(self, *statuses):
+        now = time.time()
+        self._modified_at[None] = now
+        for status in statuses:
+            self._status_versions[status] = (self.generation, self._offset)
+            self._modified_at[status] = now
+
+    # Function to append records to the current journal in one write, the store must be locked
+    # Returns the number of the write, to be passed to _wait_durable once the store is unlocked
+    def _append(self, *records):
+        if self._journal is None:
+            self._journal = open(self._journal_file(self.generation), 'ab')
+
+        with timed('persist'):
+            lines = [(json.dumps(record) + '\n').encode('utf-8') for record in records]
+            self._journal.write(b''.join(lines))
+            self._journal.flush()
+            self._written += 1
+            if self.durability == 'fsync':
+                os.fsync(self._journal.fileno())
+                self._synced = self._written
+        for record, line in zip(records, lines):
+            # Each record is applied at the position after it, like other processes reading the journal
+            self._offset += len(line)
+            self._apply(record)
+
+        if (self._offset >= max(self.compact_min_bytes, self.compact_ratio * self._snapshot_bytes)
+                and not self._compacting):
+            self._compacting = True
+            threading.Thread(target=self.compact, daemon=True).start()
+        return self._written
+
+    # Function to close the current journal, forcing what was written to it to disk first
+    def _close_journal(self):
+        if self._journal is not None:
+            if self._synced < self._written:
+                os.fsync(self._journal.fileno())
+                self._mark_synced(self._written)
+            self._journal.close()
+            self._journal = None
+
+    def _mark_synced(self, written):
+        with self._synced_changed:
+            self._synced = max(self._synced, written)
+            self._synced_changed.notify_all()
+
+    # Function to wait until a journal write is on disk, if the durability mode asks for it
+    def _wait_durable(self, written):
+        if self.durability != 'group' or not written:
+            return
+        with timed('persist'), self._synced_changed:
+            while self._synced < written and not self._closed:
+                self._synced_changed.wait()
+
+    # Function to force every journal write made so far to disk
+    def sync(self):
+        with self._lock:
+            written = self._written
+            if self._synced >= written or self._journal is None:
+                return
+            # A duplicate descriptor stays valid even if the journal is rotated meanwhile
+            descriptor = os.dup(self._journal.fileno())
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+        self._mark_synced(written)
+
+    # Function to force pending writes to disk and stop the background thread
+    def close(self):
+        if self._closed:
+            return
+        self.sync()
+        self._closed = True
+        with self._synced_changed:
+            self._synced_changed.notify_all()
+
+    # Function to pick up changes made by other processes since the last call
+    def refresh(self):
+        with self._lock:
+            self._catch_up()
+
+    # Function to get a tag that changes whenever the orders (of the given status) change
+    def version(self, status=None):
+        with self._lock:
+            if status is None:
+                generation, offset = self.generation, self._offset
+            else:
+                generation, offset = self._status_versions.get(status, self._base_version)
+        return f'{generation}.{offset}'
+
+    # Function to read the journal records written after a version, at most limit of them
+    # Returns a list of (version, record) and the version to continue from,
+    # or None if the journals of that version have already been compacted away
+    # Raises ValueError if the version doesn't point between two records of a journal
+    def changes(self, version, limit=1000):
+        generation, offset = version
+        if not 0 <= generation <= self.generation:
+            raise ValueError(f'Generation {generation} has not been started')
+        try:
+            check_record_start(self._journal_file(generation), offset)
+        except FileNotFoundError:
+            return None
+        records = []
+        while True:
+            journal = self._journal_file(generation)
+            if not os.path.exists(journal):
+                return None
+
+            # Once the next generation exists nothing more is written to this journal
+            rotated = os.path.exists(self._journal_file(generation + 1))
+            for offset, record in read_records(journal, offset):
+                if record is not None:
+                    records.append((f'{generation}.{offset}', record))
+                    if len(records) == limit:
+                        return records, (generation, offset)
+            if not rotated:
+                return records, (generation, offset)
+            generation += 1
+            offset = 0
+
+    # Function to get the time the orders (of the given status) were last seen changing
+    def last_modified(self, status=None):
+        return self._modified_at.get(status, self._loaded_at)
+
+    # Function to get an order by its id, returns None if there is no such order
+    def get(self, order_id):
+        order = self._orders_by_id.get(order_id)
+        if order is not None:
+            return order.to_dict()
+        return self.archived.get(order_id) if self.archived.segments else None
+
+    # Function to get an order by its id if it is still in memory, i.e. not archived
+    def _get_current(self, order_id):
+        order = self._orders_by_id.get(order_id)
+        return order.to_dict() if order else None
+
+    # Function to get all orders with the given status, in order of their ids
+    def by_status(self, status):
+        return [order.to_dict() for order in self._by_status(status)]
+
+    def by_status_json(self, status):
+        orders = self._by_status(status)
+        with timed('serialize'):
+            return [order.to_json() for order in orders]
+
+    # Function to get the OrderRecords of the orders with the given status, in order of their ids
+    def _by_status(self, status):
+        with timed('scan'):
+            with self._lock:
+                bucket = list(self._orders_by_status.get(status, {}).values())
+            # Buckets keep the order in which orders reached the status
+            bucket.sort(key=lambda order: order.id)
+            return bucket
+
+    # Function to get the orders of a customer in order of their ids, optionally only those with the given status
+    # Names are compared normalized, with prefix=True every name starting with name matches
+    def by_name(self, name, prefix=False, status=None):
+        key = normalize_name(name)
+        with timed('scan'):
+            with self._lock:
+                if prefix:
+                    # The names starting with the prefix sit next to each other in the sorted names
+                    position = bisect_left(self._names, key)
+                    matches = []
+                    while position < len(self._names) and self._names[position].startswith(key):
+                        matches.append(self._orders_by_name[self._names[position]])
+                        position += 1
+                else:
+                    matches = [self._orders_by_name.get(key, [])]
+                orders = [order for orders in matches for order in orders if status is None or order.status == status]
+            if len(matches) > 1:
+                orders.sort(key=lambda order: order.id)
+            return [order.to_dict() for order in orders]
+
+    # Function to get the orders dated between two dates, both inclusive
+    def by_date(self, start_date, end_date):
+        return [order_dict(order) for order in self._by_date(start_date, end_date)]
+
+    def by_date_json(self, start_date, end_date):
+        orders = self._by_date(start_date, end_date)
+        with timed('serialize'):
+            return [order_json(order) for order in orders]
+
+    # Function to get the OrderRecords of the orders dated between two dates, both inclusive,
+    # merged with the dicts of the archived ones, in order of date and id
+    def _by_date(self, start_date, end_date):
+        with timed('scan'):
+            with self._lock:
+                start = bisect_left(self._dates, start_date.toordinal())
+                end = bisect_right(self._dates, end_date.toordinal())
+                current = [self._orders_by_id[order_id] for order_id in self._date_ids[start:end]]
+                segments = self.archived.segments
+            if not segments:
+                return current
+
+            current_ids = {order.id for order in current}
+            # The dates may be datetimes, whose isoformat() has a time that would sort after the bare date
+            archived = [order for order in self.archived.by_date(start_date.strftime('%Y-%m-%d'),
+                                                                 end_date.strftime('%Y-%m-%d'), segments)
+                        if order['id'] not in current_ids]
+            return list(heapq.merge(current, archived, key=order_date_id))
+
+    # Function to yield orders in order of their ids, starting after the given id
+    def iter_orders(self, after_id=0, limit=None):
+        return map(order_dict, self._iter_orders(after_id, limit))
+
+    def iter_orders_json(self, after_id=0, limit=None):
+        return map(order_json, self._iter_orders(after_id, limit))
+
+    # Function to yield the OrderRecords of the orders merged with the dicts of the archived ones,
+    # in order of their ids, starting after the given id
+    def _iter_orders(self, after_id, limit):
+        with self._lock:
+            orders = self.orders
+            segments = self.archived.segments
+        current = self._iter_current(orders, after_id)
+        if not segments:
+            return islice(current, limit)
+
+        archived = (order for order in self.archived.iter_orders(after_id, segments)
+                    if order['id'] not in self._orders_by_id)
+        return islice(heapq.merge(current, archived, key=order_id), limit)
+
+    # Function to yield the records of a list of OrderRecords, starting after the given id
+    def _iter_current(self, orders, after_id):
+        # Orders are appended in id order, so binary search for the first one after after_id
+        low, high = 0, len(orders)
+        while low < high:
+            middle = (low + high) // 2
+            if orders[middle].id <= after_id:
+                low = middle + 1
+            else:
+                high = middle
+
+        for position in range(low, len(orders)):
+            yield orders[position]
+
+    # Function to get the number of orders, revenue and discount per day, product and status
+    def daily_totals(self, start_date, end_date):
+        with timed('scan'), self._lock:
+            return list(self.totals.rows(start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
+
+    # Function to add several orders with consecutive ids and record them in one journal write
+    def add_orders(self, orders):
+        with self._locked():
+            self._catch_up()
+            first_id = self.next_id
+            orders = [
+                {'id': first_id + number, **{key: value for key, value in order.items() if key != 'id'}}
+                for number, order in enumerate(orders)
+            ]
+            written = self._append(*({'op': 'create', 'order': order} for order in orders)) if orders else 0
+        self._wait_durable(written)
+        return orders
+
+    # Function to change the status of several orders and record them in one journal write
+    # Returns the updated orders and a list of {'id': ..., 'reason': ...} for the skipped ones
+    def set_statuses(self, order_ids, status, expected=None):
+        written = 0
+        with self._locked():
+            self._catch_up()
+            updated, skipped = check_transitions(order_ids, self._get_current, expected)
+            for entry in skipped:
+                if entry['reason'] == 'Order not found' and self.archived.get(entry['id']) is not None:
+                    entry['reason'] = 'Order is archived'
+            if updated:
+                written = self._append(*({'op': 'status', 'id': order['id'], 'status': status, 'from': order['status']}
+                                         for order in updated))
+                for order in updated:
+                    order['status'] = status
+        self._wait_durable(written)
+        return updated, skipped
+
+    # Function to move "Paid" orders older than the given number of days to the archive
+    # Returns the number of orders moved
+    def archive(self, older_than_days):
+        before = (date.today() - timedelta(days=older_than_days)).isoformat()
+        written = 0
+        with self._locked():
+            self._catch_up()
+            orders = [order.to_dict() for order in self._orders_by_status.get('Paid', {}).values()
+                      if order.date < before]
+            if orders:
+                # Segments are written first, the journal record then removes the orders from memory
+                self.archived.add(orders, f'{self.generation}-{self._offset}')
+                written = self._append({'op': 'archive', 'status': 'Paid', 'before': before})
+        self._wait_durable(written)
+        return len(orders)
+
+    # Function to start a new journal generation and write a snapshot of everything before it
+    def compact(self):
+        try:
+            if self.archive_after_days > 0:
+                self.archive(self.archive_after_days)
+            with self._locked():
+                self._catch_up()
+                self._compacting = True
+                # Writes made from now on go to the next journal
+                self._close_journal()
+                self.generation += 1
+                self._offset = 0
+                open(self._journal_file(self.generation), 'ab').close()
+                generation = self.generation
+                next_id = self.next_id
+                totals = list(self.totals.rows())
+                # Orders only change status once created, so the orders and their statuses as of the new
+                # generation are all that has to be taken under the lock, the rows are built from them after
+                orders = list(self.orders)
+                statuses = [order.status for order in orders]
+
+            # Built and written outside the lock so requests aren't blocked by the snapshot
+            snapshot = {
+                'generation': generation,
+                'next_id': next_id,
+                'totals': totals,
+                'orders': [{**order.to_dict(), 'status': status} for order, status in zip(orders, statuses)],
+            }
+            temp_path = f'{self.snapshot_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with timed('persist'), open(temp_path, 'w') as file:
+                json.dump(snapshot, file)
+                file.flush()
+                os.fsync(file.fileno())
+                snapshot_bytes = file.tell()
+
+            with self._locked():
+                if not os.path.exists(self._journal_file(generation)):
+                    # Another process has meanwhile written a newer snapshot and removed the
+                    # journal this one depends on, so this snapshot must not replace it
+                    os.remove(temp_path)
+                    return
+                os.replace(temp_path, self.snapshot_path)
+                self._snapshot_bytes = snapshot_bytes
+                # The previous journal is kept for processes that haven't finished reading it
+                for path in glob.glob(glob.escape(self.journal_path) + '.*'):
+                    suffix = path[len(self.journal_path) + 1:]
+                    if suffix.isdigit() and int(suffix) < generation - 1:
+                        os.remove(path)
+        finally:
+            self._compacting = False
+
+
+# Function to open the store of the configured backend
+def open_store(backend=BACKEND):
+    if backend == 'journal':
+        return JournalOrderStore()
+    if backend == 'sqlite':
+        from sqlite_store import SQLiteOrderStore
+        return SQLiteOrderStore()
+    raise ValueError(f"ORDERS_BACKEND must be 'journal' or 'sqlite', not {backend!r}")
+
+
+class LazyStore:
+    """
+    Store that is opened on first use instead of when orders.py is imported.
+
+    Loading a long order history takes seconds, and a service doesn't need it
+    to start accepting requests, nor to answer those that don't touch orders
+    (/metrics, /apidocs). The services call preload() to open the store on a
+    background thread; anything else that needs it waits until it is open.
+    Scripts that open their own store with open_store() don't load it twice,
+    since nothing is loaded unless the shared store is used. Every other
+    attribute is passed through to the opened store.
+    """
+
+    def __init__(self, open_store):
+        self._open_store = open_store
+        self._store = None
+        self._opening = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            # A child forked halfway through loading would inherit a half-built store
+            os.register_at_fork(before=self._opening.acquire, after_in_parent=self._opening.release,
+                                after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._opening = threading.Lock()
+
+    # Function to get the store, opening it if that hasn't been done yet
+    def _get(self):
+        store = self._store
+        if store is None:
+            with self._opening:
+                if self._store is None:
+                    self._store = self._open_store()
+                store = self._store
+        return store
+
+    # Function to start opening the store in the background
+    def preload(self):
+        threading.Thread(target=self._get, daemon=True).start()
+
+    # A store that isn't open yet will read everything when it opens, so there is nothing to pick up
+    def refresh(self):
+        if self._store is not None:
+            self._store.refresh()
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            super().__setattr__(name, value)
+        else:
+            setattr(self._get(), name, value)
 
-if not os.path.exists(orders_file_path):
-    # If the file doesn't exist, create it and initialize it with an empty list
-    with open(orders_file_path, 'w') as file:
-        json.dump([], file)
 
-# Read data from orders.json
-with open(orders_file_path, 'r') as file:
-    # Load existing data from the file into the 'orders' variable
-    orders = json.load(file)
+# Shared store used by all services, opened on first use or by preload()
+store = LazyStore(open_store)
@@ -1,18 +1,18 @@
-from flask import Flask, jsonify, Response
-from flasgger import Swagger
+from flask import Flask, jsonify, request, Response
+from docs import LazySwagger
+from metrics import instrument, timed
+from catalog import catalog
+from conditional import versioned_response
+from datetime import date
 import json
+import math
 
 app = Flask(__name__)
-Swagger(app)
+LazySwagger(app)
+instrument(app)
 
-# Sample data (fixtures)
-products = [
-    {"id": 1, "name": "Microwave Gorenje MO17E1W", "price": 2720.00, "date": "2023-10-03"},
-    {"id": 2, "name": "Robot vacuum Xiaomi Mi Robot Vacuum S10+ White", "price": 14600.00, "date": "2023-12-02"},
-    {"id": 3, "name": "Electric shaver Philips razor 7000 series S7882/55", "price": 7200.00, "date": "2023-12-04"},
-    {"id": 4, "name": "Coffee machine Krups EA895N10", "price": 18425.00, "date": "2023-10-03"},
-    {"id": 5, "name": "Electric fireplace Artiflame AF23S", "price": 15790.00, "date": "2023-12-02"}
-]
+# Serialized /products response and the catalog version it was built from
+products_response = (None, None)
 
 # Endpoint to show all items
 @app.route('/products', methods=['GET'])
@@ -45,15 +45,102 @@ def get_all_products():
                     type: string
                     format: date
                     description: The date the product was added.
+      304:
+        description: Not modified. The catalog hasn't changed since the ETag given in If-None-Match.
     """
-    # Extract necessary fields from each product and create a new list
-    ordered_products = [{key: product[key] for key in ["id", "name", "price", "date"]} for product in products]
-    
-    # Convert the list to a JSON response
-    json_response = json.dumps({"products": ordered_products})
-    
-    # Return the JSON response as a Flask Response object
-    return Response(json_response, content_type='application/json')
+    global products_response
+    current = catalog.current()
+    version, json_response = products_response
+    # The list is only serialized again after the products file changed
+    if version != current.version:
+        with timed('serialize'):
+            json_response = json.dumps({"products": current.products})
+        products_response = (current.version, json_response)
+
+    # Answered with 304 if the client already has this version of the catalog
+    return versioned_response(current.version, current.loaded_at,
+                              lambda: Response(json_response, content_type='application/json'))
+
+# Endpoint to search the products by name, price and the date they were added
+@app.route('/products/search', methods=['GET'])
+def search_products():
+    """
+    Search the products by the words of their name, their price and the date they were added.
+
+    Every condition is optional and all of them must hold. Words are matched
+    whole and regardless of case.
+
+    ---
+    parameters:
+      - name: q
+        in: query
+        type: string
+        required: false
+        description: Words that must all appear in the product name, e.g. "robot vacuum".
+      - name: min_price
+        in: query
+        type: number
+        required: false
+        description: The lowest price, inclusive.
+      - name: max_price
+        in: query
+        type: number
+        required: false
+        description: The highest price, inclusive.
+      - name: added_from
+        in: query
+        type: string
+        format: date
+        required: false
+        description: Only products added on or after this date (YYYY-MM-DD).
+      - name: added_to
+        in: query
+        type: string
+        format: date
+        required: false
+        description: Only products added on or before this date (YYYY-MM-DD).
+    responses:
+      200:
+        description: The matching products, in order of their IDs.
+        schema:
+          type: object
+          properties:
+            products:
+              type: array
+              items:
+                type: object
+                  # Structure of each product is the same as in /products
+      304:
+        description: Not modified. The catalog hasn't changed since the ETag given in If-None-Match.
+      400:
+        description: Bad request. A price is not a number or a date is not in the format YYYY-MM-DD.
+    """
+    try:
+        min_price = parse_price(request.args.get('min_price'))
+        max_price = parse_price(request.args.get('max_price'))
+        added_from = parse_date(request.args.get('added_from'))
+        added_to = parse_date(request.args.get('added_to'))
+    except ValueError:
+        return jsonify({'error': 'Prices must be numbers and dates must be in the format YYYY-MM-DD.'}), 400
+
+    current = catalog.current()
+    return versioned_response(current.version, current.loaded_at, lambda: jsonify(
+        {'products': current.search(request.args.get('q'), min_price, max_price, added_from, added_to)}))
+
+# Function to read an optional price parameter, raises ValueError if it isn't a finite number
+def parse_price(value):
+    if value is None:
+        return None
+    price = float(value)
+    if not math.isfinite(price):
+        raise ValueError(value)
+    return price
+
+# Function to read an optional YYYY-MM-DD date parameter, raises ValueError if it isn't one
+def parse_date(value):
+    if value is None:
+        return None
+    return date.fromisoformat(value).isoformat()
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,370 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from aggregates import discount_of
+from cache import LRUCache
+from catalog import catalog
+from metrics import timed
+from storage import OrderStore, check_transitions, encode_order, normalize_name
+
+# Database holding the orders when ORDERS_BACKEND is 'sqlite'
+database_file_path = 'orders.db'
+
+# Number of change records kept for the change feed, older cursors expire
+CHANGE_LOG_SIZE = 100000
+
+# Number of orders kept encoded as JSON for the list endpoints
+ENCODED_CACHE_SIZE = 100000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    product_id INTEGER,
+    price REAL,
+    date TEXT NOT NULL,
+    status TEXT NOT NULL,
+    name_key TEXT,
+    discount REAL
+);
+CREATE INDEX IF NOT EXISTS orders_by_status ON orders (status, id);
+CREATE INDEX IF NOT EXISTS orders_by_date ON orders (date, id);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    record TEXT NOT NULL,
+    changed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS status_versions (
+    status TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    changed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS daily_totals (
+    date TEXT NOT NULL,
+    product_id INTEGER,
+    status TEXT NOT NULL,
+    orders INTEGER NOT NULL,
+    revenue REAL NOT NULL,
+    discount REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS daily_totals_by_date ON daily_totals (date, product_id, status);
+"""
+
+ORDER_COLUMNS = 'id, name, product_id, price, date, status, discount'
+
+
+# Function to turn a row of the orders table into an order dict
+def row_to_order(row):
+    order = {'id': row[0]}
+    # Orders without a name or a known product have no such keys, as in the journal store
+    if row[1] is not None:
+        order['name'] = row[1]
+    if row[2] is not None:
+        order['productId'] = row[2]
+    if row[3] is not None:
+        order['price'] = row[3]
+    if row[6] is not None:
+        order['discount'] = row[6]
+    order['date'] = row[4]
+    order['status'] = row[5]
+    return order
+
+
+# Function to get the normalized name of an order to look it up by, None if it has no name
+def name_key(order):
+    name = order.get('name')
+    return normalize_name(name) if isinstance(name, str) else None
+
+
+class SQLiteOrderStore(OrderStore):
+    """
+    Orders kept in an SQLite database instead of in memory.
+
+    The database runs in WAL mode, so readers in any process never block the
+    writer, and has indexes on id, status and date, so every query of the
+    interface is answered from an index, lookups by customer name from the
+    normalized name kept next to the name. Only the orders a request asks for
+    are loaded, which lets large shops keep years of orders.
+
+    Every change is also written to a change log table whose sequence number
+    is the version of the store, which feeds ETags and the change feed, and
+    counted in the daily_totals table that revenue reports are read from.
+
+    Orders encoded as JSON for the list endpoints are cached by their whole
+    row, so an order that changed, in this process or another one, is
+    simply not found in the cache and is encoded again.
+
+    If the database is new and orders.json exists, the orders of the journal
+    store are copied into it.
+    """
+
+    def __init__(self, path=database_file_path, durability=None):
+        from orders import DURABILITY, orders_file_path
+        self.path = path
+        # 'fsync' makes every commit durable, the other modes may lose the last commits on power loss
+        self.synchronous = 'FULL' if (durability or DURABILITY) == 'fsync' else 'NORMAL'
+        self._local = threading.local()
+        self._loaded_at = time.time()
+        self._encoded = LRUCache(max_entries=ENCODED_CACHE_SIZE)
+
+        connection = self._connection()
+        with connection:
+            connection.executescript(SCHEMA)
+        self._write(self._add_missing_columns)
+        if self.next_id == 1 and os.path.exists(orders_file_path):
+            self._import_journal_store()
+        self._write(self._count_missing_totals)
+
+        if hasattr(os, 'register_at_fork'):
+            # Connections must not be shared with a forked child
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._local = threading.local()
+
+    # Function to get the connection of the current thread
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(f'PRAGMA synchronous={self.synchronous}')
+            self._local.connection = connection
+        return connection
+
+    # Function to copy the orders of the journal store into a new database
+    def _import_journal_store(self):
+        from orders import JournalOrderStore
+        journal_store = JournalOrderStore()
+        try:
+            connection = self._connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.executemany(
+                    f'INSERT INTO orders ({ORDER_COLUMNS}, name_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    ((order['id'], order.get('name'), order.get('productId'), order.get('price'),
+                      order['date'], order['status'], order.get('discount'), name_key(order))
+                     for order in journal_store.iter_orders()))
+                # Keep the id sequence even if the newest orders were removed
+                connection.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'orders'",
+                                   (journal_store.next_id - 1,))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        finally:
+            journal_store.close()
+
+    # Function to add the columns of a database created before they were kept
+    def _add_missing_columns(self, connection):
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(orders)')]
+        if 'name_key' not in columns:
+            # Normalized customer names
+            connection.execute('ALTER TABLE orders ADD COLUMN name_key TEXT')
+            rows = connection.execute('SELECT id, name FROM orders WHERE name IS NOT NULL').fetchall()
+            connection.executemany('UPDATE orders SET name_key = ? WHERE id = ?',
+                                   ((normalize_name(name), order_id) for order_id, name in rows))
+        connection.execute('CREATE INDEX IF NOT EXISTS orders_by_name ON orders (name_key, id)')
+        if 'discount' not in columns:
+            # Discount of each order as priced, worked out once for the orders already taken
+            connection.execute('ALTER TABLE orders ADD COLUMN discount REAL')
+            products = catalog.current()
+            rows = connection.execute(
+                'SELECT id, product_id, price, date FROM orders WHERE price IS NOT NULL').fetchall()
+            connection.executemany('UPDATE orders SET discount = ? WHERE id = ?', (
+                (discount_of({'productId': product_id, 'price': price, 'date': order_date}, products), order_id)
+                for order_id, product_id, price, order_date in rows))
+
+    # Function to fill in the daily totals of a database created before they were kept
+    def _count_missing_totals(self, connection):
+        if connection.execute('SELECT 1 FROM daily_totals LIMIT 1').fetchone():
+            return
+        rows = connection.execute(f'SELECT {ORDER_COLUMNS} FROM orders')
+        for order in [row_to_order(row) for row in rows]:
+            self._count(connection, order)
+
+    # Function to count an order in the daily totals, or out of them with sign=-1
+    def _count(self, connection, order, sign=1):
+        values = (sign, sign * (order.get('price') or 0), sign * discount_of(order),
+                  order['date'], order.get('productId'), order['status'])
+        updated = connection.execute(
+            'UPDATE daily_totals SET orders = orders + ?, revenue = revenue + ?, discount = discount + ? '
+            'WHERE date = ? AND product_id IS ? AND status = ?', values).rowcount
+        if not updated:
+            connection.execute('INSERT INTO daily_totals (orders, revenue, discount, date, product_id, status) '
+                               'VALUES (?, ?, ?, ?, ?, ?)', values)
+
+    # Id the next new order will get
+    @property
+    def next_id(self):
+        row = self._connection().execute("SELECT seq FROM sqlite_sequence WHERE name = 'orders'").fetchone()
+        return (row[0] if row else 0) + 1
+
+    def get(self, order_id):
+        row = self._connection().execute(
+            f'SELECT {ORDER_COLUMNS} FROM orders WHERE id = ?', (order_id,)).fetchone()
+        return row_to_order(row) if row else None
+
+    def by_status(self, status):
+        return [row_to_order(row) for row in self._rows_by_status(status)]
+
+    def by_status_json(self, status):
+        rows = self._rows_by_status(status)
+        with timed('serialize'):
+            return [self._encode(row) for row in rows]
+
+    def _rows_by_status(self, status):
+        with timed('scan'):
+            return self._connection().execute(
+                f'SELECT {ORDER_COLUMNS} FROM orders WHERE status = ? ORDER BY id', (status,)).fetchall()
+
+    def by_name(self, name, prefix=False, status=None):
+        key = normalize_name(name)
+        if not prefix:
+            condition, values = 'name_key = ?', [key]
+        elif key:
+            # Strings compare by code point, so the names with the prefix sort below the prefix
+            # with its last character replaced by the next one
+            condition, values = 'name_key >= ? AND name_key < ?', [key, key[:-1] + chr(ord(key[-1]) + 1)]
+        else:
+            condition, values = 'name_key IS NOT NULL', []
+        if status is not None:
+            condition += ' AND status = ?'
+            values.append(status)
+        with timed('scan'):
+            rows = self._connection().execute(
+                f'SELECT {ORDER_COLUMNS} FROM orders WHERE {condition} ORDER BY id', values)
+            return [row_to_order(row) for row in rows]
+
+    def by_date(self, start_date, end_date):
+        return [row_to_order(row) for row in self._rows_by_date(start_date, end_date)]
+
+    def by_date_json(self, start_date, end_date):
+        rows = self._rows_by_date(start_date, end_date)
+        with timed('serialize'):
+            return [self._encode(row) for row in rows]
+
+    def _rows_by_date(self, start_date, end_date):
+        with timed('scan'):
+            return self._connection().execute(
+                f'SELECT {ORDER_COLUMNS} FROM orders WHERE date BETWEEN ? AND ? ORDER BY date, id',
+                (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))).fetchall()
+
+    def iter_orders(self, after_id=0, limit=None):
+        return map(row_to_order, self._iter_rows(after_id, limit))
+
+    def iter_orders_json(self, after_id=0, limit=None):
+        return map(self._encode, self._iter_rows(after_id, limit))
+
+    def _iter_rows(self, after_id, limit):
+        return self._connection().execute(
+            f'SELECT {ORDER_COLUMNS} FROM orders WHERE id > ? ORDER BY id LIMIT ?',
+            (after_id, -1 if limit is None else limit))
+
+    # Function to get the order of a row as JSON bytes, see encode_order
+    def _encode(self, row):
+        encoded = self._encoded.get(row)
+        if encoded is None:
+            encoded = encode_order(row_to_order(row))
+            self._encoded.put(row, encoded)
+        return encoded
+
+    # Function to run fn(connection) in a write transaction, returns its result
+    def _write(self, fn):
+        connection = self._connection()
+        with timed('persist'):
+            # IMMEDIATE takes the write lock up front, so the checks made in fn stay valid until commit
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(connection)
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        return result
+
+    # Function to record a change in the change log and the versions of the statuses it touches
+    def _log_change(self, connection, record, statuses):
+        now = time.time()
+        seq = connection.execute('INSERT INTO changes (record, changed_at) VALUES (?, ?)',
+                                 (json.dumps(record), now)).lastrowid
+        connection.executemany(
+            'INSERT OR REPLACE INTO status_versions (status, seq, changed_at) VALUES (?, ?, ?)',
+            ((status, seq, now) for status in statuses))
+        if seq % 1000 == 0:
+            connection.execute('DELETE FROM changes WHERE seq <= ?', (seq - CHANGE_LOG_SIZE,))
+
+    def add_orders(self, orders):
+        def insert(connection):
+            added = []
+            for order in orders:
+                order_id = connection.execute(
+                    'INSERT INTO orders (name, product_id, price, date, status, discount, name_key) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (order.get('name'), order.get('productId'), order.get('price'),
+                     order['date'], order['status'], order.get('discount'), name_key(order))).lastrowid
+                order = {'id': order_id, **{key: value for key, value in order.items() if key != 'id'}}
+                self._log_change(connection, {'op': 'create', 'order': order}, [order['status']])
+                self._count(connection, order)
+                added.append(order)
+            return added
+
+        return self._write(insert) if orders else []
+
+    def set_statuses(self, order_ids, status, expected=None):
+        def update(connection):
+            updated, skipped = check_transitions(order_ids, self.get, expected)
+            for order in updated:
+                connection.execute('UPDATE orders SET status = ? WHERE id = ?', (status, order['id']))
+                self._count(connection, order, -1)
+                self._count(connection, {**order, 'status': status})
+                self._log_change(connection, {'op': 'status', 'id': order['id'], 'status': status,
+                                              'from': order['status']}, [order['status'], status])
+                order['status'] = status
+            return updated, skipped
+
+        return self._write(update)
+
+    def daily_totals(self, start_date, end_date):
+        with timed('scan'):
+            rows = self._connection().execute(
+                'SELECT date, product_id, status, orders, ROUND(revenue, 2), ROUND(discount, 2) FROM daily_totals '
+                'WHERE date BETWEEN ? AND ? AND orders != 0 ORDER BY date',
+                (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
+            return [tuple(row) for row in rows]
+
+    def version(self, status=None):
+        connection = self._connection()
+        if status is None:
+            row = connection.execute('SELECT MAX(seq) FROM changes').fetchone()
+        else:
+            row = connection.execute('SELECT seq FROM status_versions WHERE status = ?', (status,)).fetchone()
+        return f'0.{row[0] if row and row[0] is not None else 0}'
+
+    def last_modified(self, status=None):
+        connection = self._connection()
+        if status is None:
+            row = connection.execute('SELECT changed_at FROM changes ORDER BY seq DESC LIMIT 1').fetchone()
+        else:
+            row = connection.execute('SELECT changed_at FROM status_versions WHERE status = ?', (status,)).fetchone()
+        return row[0] if row else self._loaded_at
+
+    def changes(self, version, limit=1000):
+        generation, seq = version
+        connection = self._connection()
+        oldest, newest = connection.execute('SELECT MIN(seq), MAX(seq) FROM changes').fetchone()
+        if generation == 0 and not 0 <= seq <= (newest or 0):
+            raise ValueError(f'Change {seq} has not been made')
+        # Changes right after the cursor have been removed from the log
+        if generation != 0 or (oldest is not None and oldest > seq + 1):
+            return None
+
+        rows = connection.execute('SELECT seq, record FROM changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                                  (seq, limit)).fetchall()
+        records = [(f'0.{row_seq}', json.loads(record)) for row_seq, record in rows]
+        return records, (0, rows[-1][0] if rows else seq)
+
+    def sync(self):
+        self._connection().execute('PRAGMA wal_checkpoint(PASSIVE)')
@@ -0,0 +1,165 @@
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+
+
+class OrderStore(ABC):
+    """
+    Interface of the order storage used by the cashier, consultant and accountant.
+
+    Orders are dicts with the keys id, name, productId, price, discount, date
+    (YYYY-MM-DD) and status (Accepted, Done or Paid). Implementations: JournalOrderStore in
+    orders.py (the default) and SQLiteOrderStore in sqlite_store.py. A backend
+    missing one of the abstract methods can't be created.
+    """
+
+    # Function to pick up changes made by other processes since the last call
+    def refresh(self):
+        pass
+
+    # Function to get an order by its id, returns None if there is no such order
+    @abstractmethod
+    def get(self, order_id):
+        raise NotImplementedError
+
+    # Function to get all orders with the given status, in order of their ids
+    @abstractmethod
+    def by_status(self, status):
+        raise NotImplementedError
+
+    # Function to get the orders of a customer in order of their ids, optionally only those with the given status
+    # Names are compared normalized (see normalize_name), with prefix=True every name starting with name matches
+    @abstractmethod
+    def by_name(self, name, prefix=False, status=None):
+        raise NotImplementedError
+
+    # Function to get the orders dated between two dates, both inclusive, in order of date and id
+    @abstractmethod
+    def by_date(self, start_date, end_date):
+        raise NotImplementedError
+
+    # Function to yield orders in order of their ids, starting after the given id
+    @abstractmethod
+    def iter_orders(self, after_id=0, limit=None):
+        raise NotImplementedError
+
+    # Functions to get the same orders as by_status, by_date and iter_orders, each encoded as JSON by encode_order
+    # Implementations keep the encoded orders, so a list only encodes the orders that changed since it was last sent
+    def by_status_json(self, status):
+        return [encode_order(order) for order in self.by_status(status)]
+
+    def by_date_json(self, start_date, end_date):
+        return [encode_order(order) for order in self.by_date(start_date, end_date)]
+
+    def iter_orders_json(self, after_id=0, limit=None):
+        return (encode_order(order) for order in self.iter_orders(after_id, limit))
+
+    # Function to get the number of orders, revenue and discount per day, product and status
+    # Returns (date, product_id, status, orders, revenue, discount) rows for the days
+    # between two dates, both inclusive, without reading the orders themselves
+    @abstractmethod
+    def daily_totals(self, start_date, end_date):
+        raise NotImplementedError
+
+    # Function to add several orders with consecutive ids, returns the added orders
+    @abstractmethod
+    def add_orders(self, orders):
+        raise NotImplementedError
+
+    # Function to add a new order with the next free id
+    def add_order(self, order):
+        return self.add_orders([order])[0]
+
+    # Function to change the status of several orders
+    # Returns the updated orders and a list of {'id': ..., 'reason': ...} for the skipped ones
+    @abstractmethod
+    def set_statuses(self, order_ids, status, expected=None):
+        raise NotImplementedError
+
+    # Function to change the status of an order
+    # Returns None if the order doesn't exist or isn't in the expected status
+    def set_status(self, order_id, status, expected=None):
+        updated, _ = self.set_statuses([order_id], status, expected)
+        return updated[0] if updated else None
+
+    # Function to get a tag that changes whenever the orders (of the given status) change
+    # Tags look like "<generation>.<position>" and can be passed to changes()
+    @abstractmethod
+    def version(self, status=None):
+        raise NotImplementedError
+
+    # Function to get the time the orders (of the given status) were last seen changing
+    @abstractmethod
+    def last_modified(self, status=None):
+        raise NotImplementedError
+
+    # Function to read the change records written after a version, at most limit of them
+    # Returns a list of (version, record) and the version to continue from,
+    # or None if the changes after that version are no longer kept
+    # Raises ValueError if the version isn't one the store could have handed out
+    @abstractmethod
+    def changes(self, version, limit=1000):
+        raise NotImplementedError
+
+    # Function to force every change made so far to disk
+    def sync(self):
+        pass
+
+    # Function to force pending changes to disk before the process exits
+    def close(self):
+        pass
+
+
+# Function to get the form of a customer name used to look orders up by name
+# Case and repeated or surrounding spaces are ignored, so "  ivan  PETRENKO" finds "Ivan Petrenko"
+def normalize_name(name):
+    return ' '.join(name.split()).casefold()
+
+
+# Function to encode an order as JSON bytes the way jsonify does outside debug mode, with sorted keys and no spaces
+def encode_order(order):
+    return json.dumps(order, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+# Function to build the JSON of {key: [orders], **fields} from orders encoded by encode_order
+# Gives the same bytes as jsonify({key: orders, **fields}) outside debug mode
+def join_encoded(key, encoded_orders, **fields):
+    members = {name: json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8')
+               for name, value in fields.items()}
+    members[key] = b'[' + b','.join(encoded_orders) + b']'
+    return b'{' + b','.join(json.dumps(name).encode('utf-8') + b':' + members[name]
+                            for name in sorted(members)) + b'}\n'
+
+
+# Function to check the orders of a status change, shared by the implementations
+# Returns the orders to update and a list of {'id': ..., 'reason': ...} for the skipped ones
+def check_transitions(order_ids, get_order, expected):
+    updated = []
+    skipped = []
+    seen = set()
+    for order_id in order_ids:
+        if not isinstance(order_id, int) or isinstance(order_id, bool):
+            skipped.append({'id': order_id, 'reason': 'Invalid ID'})
+            continue
+        order = get_order(order_id)
+        if order_id in seen:
+            skipped.append({'id': order_id, 'reason': 'Duplicate ID'})
+        elif order is None:
+            skipped.append({'id': order_id, 'reason': 'Order not found'})
+        elif expected is not None and order['status'] != expected:
+            skipped.append({'id': order_id, 'reason': f'Order is in "{order["status"]}" status'})
+        else:
+            updated.append(order)
+        seen.add(order_id)
+    return updated, skipped
+
+
+# Function to replace a file with new JSON content without ever leaving a partly written file
+def write_json_atomically(path, data, indent=None):
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(data, file, indent=indent)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
@@ -0,0 +1,93 @@
+# Stress test for running the services with several worker processes.
+#
+# Starts a number of worker processes with several threads each, all sharing one
+# fresh order store in a temporary directory. Every thread adds orders through
+# the cashier app, moves them to "Done" through the consultant app and marks them
+# paid, then the store is loaded again and checked for lost orders, duplicate ids
+# and orders left in the wrong status.
+#
+# Usage: python stress.py [workers] [threads per worker] [orders per thread]
+
+import os
+import sys
+import tempfile
+import threading
+from multiprocessing import Pool
+
+# Compact often so that journal rotation is exercised too
+COMPACT_RATIO = 0.05
+COMPACT_MIN_BYTES = 4096
+
+
+# Function to run the order lifecycle from several threads of one worker process
+def run_worker(directory, threads, orders_per_thread):
+    os.chdir(directory)
+    import orders
+    orders.store.compact_ratio = COMPACT_RATIO
+    orders.store.compact_min_bytes = COMPACT_MIN_BYTES
+    import cashier
+    import consultant
+
+    order_ids = []
+    errors = []
+
+    def run_thread(number):
+        cashier_client = cashier.app.test_client()
+        consultant_client = consultant.app.test_client()
+        for i in range(orders_per_thread):
+            response = cashier_client.post('/cashier/add_new_order',
+                                           json={'name': f'Customer {os.getpid()}-{number}-{i}', 'productId': 1})
+            order_id = response.get_json()['order']['id']
+            order_ids.append(order_id)
+            if consultant_client.put(f'/consultant/update_status/{order_id}').status_code != 200:
+                errors.append(f'update_status of order {order_id} failed')
+            if cashier_client.put(f'/cashier/mark_paid/{order_id}').status_code != 200:
+                errors.append(f'mark_paid of order {order_id} failed')
+
+    workers = [threading.Thread(target=run_thread, args=(number,)) for number in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return order_ids, errors
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:4]]
+    workers, threads, orders_per_thread = args + [4, 4, 50][len(args):]
+    directory = tempfile.mkdtemp(prefix='orders-stress-')
+    print(f'{workers} workers x {threads} threads x {orders_per_thread} orders in {directory}')
+
+    with Pool(workers) as pool:
+        results = pool.starmap(run_worker, [(directory, threads, orders_per_thread)] * workers)
+
+    order_ids = [order_id for ids, _ in results for order_id in ids]
+    errors = [error for _, worker_errors in results for error in worker_errors]
+    expected = workers * threads * orders_per_thread
+
+    # Load the store from disk again, as a restarted service would
+    os.chdir(directory)
+    from orders import open_store
+    store = open_store()
+    stored_orders = list(store.iter_orders())
+    if len(order_ids) != expected:
+        errors.append(f'{expected - len(order_ids)} orders were not created')
+    if len(set(order_ids)) != len(order_ids):
+        errors.append(f'{len(order_ids) - len(set(order_ids))} duplicate order ids were handed out')
+    if len(stored_orders) != len(set(order_ids)):
+        errors.append(f'store holds {len(stored_orders)} orders, expected {len(set(order_ids))}')
+    not_paid = [order_id for order_id in order_ids if (store.get(order_id) or {}).get('status') != 'Paid']
+    if not_paid:
+        errors.append(f'{len(not_paid)} orders are not "Paid", e.g. {not_paid[:5]}')
+    if store.next_id != max(order_ids, default=0) + 1:
+        errors.append(f'next id is {store.next_id}, expected {max(order_ids, default=0) + 1}')
+
+    for error in errors[:20]:
+        print('FAIL:', error)
+    if errors:
+        sys.exit(1)
+    print(f'OK: {len(order_ids)} orders created and paid, none lost')
+
+
+if __name__ == '__main__':
+    main()
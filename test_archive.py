@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from orders import JournalOrderStore
+
+
+class ArchivedDateRangeTest(unittest.TestCase):
+    """Archived orders are found by date range queries, as the endpoints make them with datetimes."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='orders-test-')
+        self.store = JournalOrderStore(
+            snapshot_path=os.path.join(self.directory, 'orders.json'),
+            journal_path=os.path.join(self.directory, 'orders.journal'),
+            lock_path=os.path.join(self.directory, 'orders.lock'),
+            archive_directory=os.path.join(self.directory, 'archive'),
+            durability='fsync')
+        self.store.add_orders([
+            {'name': 'Ivan', 'productId': 1, 'price': 2176.0, 'date': date, 'status': 'Paid'}
+            for date in ('2023-12-04', '2023-12-05', '2023-12-05', '2023-12-06')
+        ])
+        self.store.add_order({'name': 'Olena', 'productId': 2, 'price': 14600.0, 'date': '2023-12-05',
+                              'status': 'Done'})
+        self.assertEqual(self.store.archive(30), 4)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_single_day(self):
+        orders = self.store.by_date(datetime(2023, 12, 5), datetime(2023, 12, 5))
+        self.assertEqual([order['id'] for order in orders], [2, 3, 5])
+
+    def test_range_bounds_are_inclusive(self):
+        orders = self.store.by_date(datetime(2023, 12, 4), datetime(2023, 12, 6))
+        self.assertEqual([order['id'] for order in orders], [1, 2, 3, 5, 4])
+
+    def test_range_without_orders(self):
+        self.assertEqual(self.store.by_date(datetime(2023, 12, 7), datetime(2023, 12, 31)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()